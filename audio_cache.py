@@ -0,0 +1,160 @@
+"""Size-bounded cache of synthesized audio with an on-disk index.
+
+Every file in the cache directory is described in index.json by its key,
+voice, language, encoding, SSML flag, size and last-used time.  The key
+covers all of those, so changing the voice never serves stale audio.
+Files are written to a temporary name and renamed into place, so a crash
+mid-synthesis can't leave a truncated file behind.  When the directory
+grows past its byte budget the least recently used files are evicted,
+except for pinned ones (the replies of the current script).
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+INDEX_FILE = 'index.json'
+
+EXTENSIONS = {
+    'MP3': '.mp3',
+    'LINEAR16': '.wav',
+    'OGG_OPUS': '.ogg',
+}
+
+
+class AudioCache(object):
+    def __init__(self, directory, budget=512 * 2 ** 20):
+        self.directory = directory
+        self.budget = budget
+        self._lock = threading.RLock()
+        self._pinned = set()
+        self._entries = {}
+        self._dirty = False
+        self.load()
+
+    @staticmethod
+    def key(txt, voice, lang, encoding='MP3', ssml=False):
+        h = hashlib.md5()
+        for part in (voice, lang, encoding, 'ssml' if ssml else 'text', txt):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def filename(self, key, encoding='MP3'):
+        entry = self._entries.get(key)
+        if entry is not None:
+            encoding = entry['encoding']
+        return os.path.join(self.directory, key + EXTENSIONS[encoding])
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    @property
+    def size(self):
+        return sum(e['size'] for e in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        try:
+            with open(self.index_filename, encoding='utf-8') as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            entries = {}
+        # Drop entries whose file went missing.
+        self._entries = {k: e for k, e in entries.items()
+                if os.path.isfile(self.filename(k, e['encoding']))}
+        self._dirty = len(self._entries) != len(entries)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp = self.index_filename + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                json.dump(self._entries, fh, indent=1)
+            os.replace(tmp, self.index_filename)
+            self._dirty = False
+
+    def get(self, key):
+        """Returns the cached file name and marks it used, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['last_used'] = time.time()
+            self._dirty = True
+            return self.filename(key)
+
+    @contextlib.contextmanager
+    def writer(self, key, voice, lang, encoding='MP3', ssml=False):
+        """Yields a file object, the audio is committed when the block ends."""
+        filename = self.filename(key, encoding)
+        tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+        try:
+            with open(tmp, 'wb') as fh:
+                yield fh
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, filename)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+
+        with self._lock:
+            self._entries[key] = {
+                'voice': voice,
+                'lang': lang,
+                'encoding': encoding,
+                'ssml': ssml,
+                'size': os.path.getsize(filename),
+                'last_used': time.time(),
+            }
+            self._dirty = True
+            self.evict()
+            self.flush()
+
+    def pin(self, keys, replace=False):
+        """Protects `keys` from eviction, `replace` drops older pins."""
+        with self._lock:
+            if replace:
+                self._pinned = set(keys)
+            else:
+                self._pinned.update(keys)
+
+    def evict(self):
+        with self._lock:
+            size = self.size
+            if size <= self.budget:
+                return
+            candidates = sorted((e['last_used'], k)
+                    for k, e in self._entries.items()
+                    if k not in self._pinned)
+            for _, key in candidates:
+                if size <= self.budget:
+                    break
+                with contextlib.suppress(OSError):
+                    os.unlink(self.filename(key))
+                size -= self._entries.pop(key)['size']
+                self._dirty = True
+
+    def prune(self):
+        """Removes cache-named files that are not in the index."""
+        name = re.compile(r'^[0-9a-f]{32}\.(mp3|wav|ogg)(\..*\.tmp)?$')
+        with self._lock:
+            for filename in os.listdir(self.directory):
+                key = filename.split('.')[0]
+                if name.match(filename) and (key not in self._entries or
+                        filename.endswith('.tmp')):
+                    with contextlib.suppress(OSError):
+                        os.unlink(os.path.join(self.directory, filename))
@@ -0,0 +1,369 @@
+"""Pre-upload audio pipeline for streaming recognition.
+
+Microphone audio goes through three stages before it is sent:
+
+ * Resampler: 44.1 kHz capture down to 16 kHz, which is all the
+   recognizer needs, with a windowed-sinc anti-aliasing filter.
+ * EnergyVAD: frame energy against an adaptive noise floor plus the share
+   of energy in the speech band.  The gate opens with `preroll_ms` of
+   audio from before the speech started and closes after `hangover_ms`
+   of silence, so silence and the room are never uploaded.
+ * StreamEncoder: optional FLAC or Ogg Opus encoding via soundfile.
+
+The benchmark prints the upload size of every configuration and the
+end of speech to final transcript latency it leads to.  The latency is
+modelled: chunks are sent in real time over an uplink of `--uplink-kbps`,
+the service is assumed to finalize `--endpointer-ms` after speech ends
+when nothing half-closes the request, and its recognition time, the same
+for every configuration, is left out.
+
+Example usage:
+    python audio_pipeline.py
+    python audio_pipeline.py recording.wav --uplink-kbps 256
+"""
+
+import argparse
+import collections
+import io
+import math
+import time
+import wave
+
+import numpy
+
+STT_RATE = 16000
+
+ENCODINGS = {
+    # encoding: (soundfile format, subtype), None is raw PCM
+    'LINEAR16': None,
+    'FLAC': ('FLAC', 'PCM_16'),
+    'OGG_OPUS': ('OGG', 'OPUS'),
+}
+
+
+class Resampler(object):
+    """Streaming int16 resampler, keeps filter state between blocks."""
+    def __init__(self, from_rate, to_rate, taps=63):
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.step = from_rate / float(to_rate)
+
+        cutoff = 0.45 * min(1., to_rate / float(from_rate))
+        n = numpy.arange(taps) - (taps - 1) / 2.
+        h = 2 * cutoff * numpy.sinc(2 * cutoff * n) * numpy.hamming(taps)
+        self._filter = (h / h.sum()).astype(numpy.float32)
+        self._history = numpy.zeros(taps - 1, dtype=numpy.float32)
+        self._prev = 0.
+        self._pos = 0.
+
+    def __call__(self, samples):
+        if self.from_rate == self.to_rate:
+            return samples
+        x = numpy.concatenate([self._history, samples.astype(numpy.float32)])
+        y = numpy.convolve(x, self._filter, mode='valid')
+        self._history = x[len(x) - len(self._history):]
+
+        # yy[0] is the last filtered sample of the previous block.
+        yy = numpy.concatenate([[self._prev], y])
+        positions = numpy.arange(self._pos, len(y) - 1 + 1e-9, self.step)
+        out = numpy.interp(positions + 1, numpy.arange(len(yy)), yy)
+        if len(positions):
+            self._pos = positions[-1] + self.step - len(y)
+        else:
+            self._pos -= len(y)
+        self._prev = yy[-1]
+        return numpy.clip(out, -32768, 32767).astype(numpy.int16)
+
+
+class EnergyVAD(object):
+    """Frame classifier with an adaptive noise floor."""
+    def __init__(self, rate, ratio=3., band=(300, 3400), band_share=0.5,
+            min_floor=30.):
+        self.rate = rate
+        self.ratio = ratio
+        self.band = band
+        self.band_share = band_share
+        self.floor = min_floor
+        self.min_floor = min_floor
+
+    def is_speech(self, frame):
+        x = frame.astype(numpy.float32)
+        energy = numpy.sqrt(numpy.mean(x * x))
+        power = numpy.abs(numpy.fft.rfft(x)) ** 2
+        freqs = numpy.fft.rfftfreq(len(x), 1. / self.rate)
+        in_band = power[(freqs >= self.band[0]) & (freqs <= self.band[1])]
+        share = in_band.sum() / (power.sum() + 1e-9)
+
+        speech = energy > self.floor * self.ratio and share > self.band_share
+        if not speech:
+            self.floor = max(self.min_floor,
+                    0.95 * self.floor + 0.05 * energy)
+        return speech
+
+
+class AudioPipeline(object):
+    """Resamples and gates int16 mono audio.
+
+    `process` returns ``(pcm_bytes, ended)``: the audio to send and
+    whether the gate just closed on end of speech.  With `gate` off
+    everything is passed through but the end of speech is still tracked,
+    which makes latency comparable between the two modes.
+    """
+    def __init__(self, in_rate, out_rate=STT_RATE, vad=True, gate=True,
+            encoding='LINEAR16', frame_ms=30, preroll_ms=300,
+            hangover_ms=600, clock=time.time):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported encoding {}".format(encoding))
+        self.in_rate = in_rate
+        self.rate = out_rate
+        self.encoding = encoding
+        self.gate = gate
+        self.hangover_ms = hangover_ms
+        self.clock = clock
+        self.resampler = Resampler(in_rate, out_rate)
+        self.vad = EnergyVAD(out_rate) if vad else None
+
+        self._frame = int(out_rate * frame_ms / 1000)
+        self._hangover = int(hangover_ms / frame_ms)
+        self._preroll = collections.deque(maxlen=int(preroll_ms / frame_ms))
+        self._pending = numpy.zeros(0, dtype=numpy.int16)
+        self._silence = 0
+        self.open = not (vad and gate)
+        self.speaking = False
+        # clock() of the last end of speech, for latency measurements.
+        self.speech_ended_at = None
+
+    @property
+    def opens_on_speech(self):
+        return self.vad is not None and self.gate
+
+    def encoder(self):
+        return StreamEncoder(self.encoding, self.rate)
+
+    def process(self, data):
+        samples = numpy.frombuffer(data, dtype=numpy.int16)
+        samples = self.resampler(samples)
+        if self.vad is None:
+            return samples.tobytes(), False
+
+        pending = numpy.concatenate([self._pending, samples])
+        nframes = len(pending) // self._frame
+        self._pending = pending[nframes * self._frame:]
+
+        out, ended = [], False
+        for i in range(nframes):
+            frame = pending[i * self._frame:(i + 1) * self._frame]
+            if self.vad.is_speech(frame):
+                self.speaking = True
+                self._silence = 0
+            elif self.speaking:
+                self._silence += 1
+                if self._silence >= self._hangover:
+                    self.speaking = False
+                    hangover = self._hangover * self._frame / float(self.rate)
+                    self.speech_ended_at = self.clock() - hangover
+                    if self.gate:
+                        out.append(frame)
+                        self.open = False
+                        ended = True
+                        continue
+
+            if not self.gate or self.open:
+                out.append(frame)
+            elif self.speaking:
+                self.open = True
+                out.extend(self._preroll)
+                self._preroll.clear()
+                out.append(frame)
+            else:
+                self._preroll.append(frame)
+
+        return b''.join(f.tobytes() for f in out), ended
+
+
+class StreamEncoder(object):
+    """Encodes one streaming request worth of PCM into a single stream.
+
+    FLAC and Opus hold back the last frames until the stream is closed,
+    `close` returns them.
+    """
+    def __init__(self, encoding, rate):
+        self._file = None
+        self._raw = ENCODINGS[encoding] is None
+        if self._raw:
+            return
+        import soundfile
+
+        fmt, subtype = ENCODINGS[encoding]
+        self._buffer = io.BytesIO()
+        self._sent = 0
+        self._file = soundfile.SoundFile(self._buffer, 'w', rate, 1,
+                format=fmt, subtype=subtype)
+
+    def _take(self):
+        data = self._buffer.getvalue()
+        out, self._sent = data[self._sent:], len(data)
+        return out
+
+    def encode(self, pcm):
+        if self._raw:
+            return pcm
+        self._file.write(numpy.frombuffer(pcm, dtype=numpy.int16))
+        self._file.flush()
+        return self._take()
+
+    def close(self):
+        """Ends the stream, returns the bytes not sent yet."""
+        if self._file is None:
+            return b''
+        self._file.close()
+        self._file = None
+        return self._take()
+
+
+def synthetic_show(rate, seconds=60, speech_share=0.3, seed=0):
+    """Room noise with syllable-modulated, band-limited bursts."""
+    rng = numpy.random.default_rng(seed)
+    n = int(rate * seconds)
+    signal = 100 * rng.standard_normal(n)
+    t = numpy.arange(n) / float(rate)
+    pos = 0
+    while pos < n:
+        gap = int(rate * rng.uniform(2, 6) * (1 - speech_share) / speech_share
+                * 0.5)
+        length = int(rate * rng.uniform(1, 3))
+        start, end = pos + gap, min(pos + gap + length, n)
+        if start >= n:
+            break
+        voice = rng.standard_normal(end - start)
+        voice = numpy.convolve(voice, numpy.ones(8) / 8, mode='same')
+        envelope = 0.5 + 0.5 * numpy.sin(2 * numpy.pi * 4 * t[start:end])
+        signal[start:end] += 6000 * voice * envelope
+        pos = end
+    return numpy.clip(signal, -32768, 32767).astype(numpy.int16)
+
+
+def read_wav(filename):
+    with wave.open(filename, 'rb') as w:
+        pcm = numpy.frombuffer(w.readframes(w.getnframes()),
+                dtype=numpy.int16)
+        if w.getnchannels() > 1:
+            pcm = pcm.reshape(-1, w.getnchannels())[:, 0].copy()
+        return pcm, w.getframerate()
+
+
+def uplink(chunks, kbps):
+    """Arrival times of ``(sent at, bytes)`` chunks sent in order."""
+    arrivals, free = [], 0.
+    for sent, size in chunks:
+        free = max(free, sent) + size * 8. / (kbps * 1000.)
+        arrivals.append(free)
+    return arrivals
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return float('nan'), float('nan')
+    return (samples[len(samples) // 2],
+            samples[min(len(samples) - 1, int(0.9 * len(samples)))])
+
+
+def benchmark(samples, rate, chunk_seconds=0.1, uplink_kbps=512,
+        endpointer_ms=800):
+    """Prints upload size and end of speech to final transcript latency
+    for each pipeline configuration, see the module docstring."""
+    minutes = len(samples) / float(rate) / 60
+    chunk = int(rate * chunk_seconds)
+    endpointer = endpointer_ms / 1000.
+    configs = [
+        ('raw {} Hz LINEAR16'.format(rate), None),
+        ('16 kHz LINEAR16', dict(vad=False)),
+        ('16 kHz LINEAR16 + VAD', dict()),
+        ('16 kHz FLAC + VAD', dict(encoding='FLAC')),
+        ('16 kHz OGG_OPUS + VAD', dict(encoding='OGG_OPUS')),
+    ]
+
+    def run(pipeline, encoder):
+        """Streams `samples` in virtual time, returns the sent chunks and
+        ``(speech ended at, index of the chunk that half-closed)``."""
+        clock = [0.]
+        if pipeline is not None:
+            pipeline.clock = lambda: clock[0]
+        sent, ends = [], []
+        for i in range(0, len(samples), chunk):
+            clock[0] = (i + chunk) / float(rate)
+            data = samples[i:i + chunk].tobytes()
+            ended = False
+            if pipeline is not None:
+                data, ended = pipeline.process(data)
+            data = encoder.encode(data) if data else b''
+            if ended:
+                data += encoder.close()
+                encoder = pipeline.encoder()
+            if data or ended:
+                sent.append((clock[0], len(data)))
+            if ended:
+                ends.append((pipeline.speech_ended_at, len(sent) - 1))
+        return sent, ends
+
+    # Where speech ends, as the gating VAD sees it.
+    reference = [ended_at for ended_at, i in
+                 run(AudioPipeline(rate), StreamEncoder('LINEAR16', rate))[1]]
+
+    print("{:<24} {:>12} {:>10} {:>12} {:>12}".format('', 'bytes/min',
+        'CPU s/min', 'p50 latency', 'p90 latency'))
+    for name, kwargs in configs:
+        pipeline = None
+        if kwargs is not None:
+            pipeline = AudioPipeline(rate, **kwargs)
+        try:
+            encoder = pipeline.encoder() if pipeline else \
+                    StreamEncoder('LINEAR16', rate)
+        except (ImportError, OSError, RuntimeError) as e:
+            print("{:<24} unavailable: {}".format(name, e))
+            continue
+        t1 = time.time()
+        sent, ends = run(pipeline, encoder)
+        cpu = (time.time() - t1) / minutes
+        arrivals = uplink(sent, uplink_kbps)
+
+        latencies = []
+        if pipeline is not None and pipeline.opens_on_speech:
+            # The final comes once the half-closed request is uploaded.
+            latencies = [arrivals[i] - ended_at for ended_at, i in ends]
+        else:
+            # The service's endpointer waits for enough silence to arrive.
+            for ended_at in reference:
+                i = int(math.ceil((ended_at + endpointer) / chunk_seconds))
+                if i - 1 < len(arrivals):
+                    latencies.append(arrivals[i - 1] - ended_at)
+        p50, p90 = percentiles(latencies)
+        total = sum(size for sent_at, size in sent)
+        print("{:<24} {:>12.0f} {:>10.2f} {:>10.0f}ms {:>10.0f}ms".format(
+            name, total / minutes, cpu, p50 * 1000, p90 * 1000))
+
+    print("Latency over a {} kbps uplink, a {} ms endpointer without the "
+          "gate, recognition time left out.".format(uplink_kbps,
+              endpointer_ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('wav', nargs='?',
+            help='A 16-bit WAV recording, a synthetic show by default.')
+    parser.add_argument('--uplink-kbps', type=float, default=512,
+            help='Upload bandwidth the latency is modelled with.')
+    parser.add_argument('--endpointer-ms', type=int, default=800,
+            help='Silence the service waits for when not half-closed.')
+    args = parser.parse_args()
+
+    if args.wav:
+        samples, rate = read_wav(args.wav)
+    else:
+        rate = 44100
+        samples = synthetic_show(rate)
+    benchmark(samples, rate, uplink_kbps=args.uplink_kbps,
+            endpointer_ms=args.endpointer_ms)
@@ -0,0 +1,221 @@
+"""Several characters on one stage, in one process.
+
+Every character has its own script, voice, microphone, wake word, audio
+cache and TTS queue, and runs its own Listener on a thread.  The word2vec
+model (mmapped or a pruned store) and the morphology are loaded once and
+shared read-only, so each extra character only adds its script index and
+caches.  All replies go through one PlaybackEngine, which plays a reply
+as a whole before the next one, so characters never talk over each
+other.  While any of them speaks only commands are heard, so the
+characters never answer each other or themselves.
+
+Characters are given as NAME:SCRIPT:VOICE[:DEVICE], NAME is also the
+wake word for operator commands and the sound_dir subdirectory:
+
+    python characters.py василиса:script-ru-RU.txt:ru-RU-Wavenet-A:1 \\
+                         петрович:script-petrovich.txt:ru-RU-Wavenet-B:2
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+
+import main
+import startup
+from audio_cache import AudioCache
+from audio_pipeline import AudioPipeline, ENCODINGS
+from embedding_store import EmbeddingStore
+from model_cache import load_model
+from playback import PlaybackEngine
+from script_journal import ScriptJournal, ScriptWatcher
+from speculative import SpeculativeReader
+from transcribe_streaming_mic import RecognitionSession, RATE
+from tts_service import TTSService
+from warmup import Warmup
+
+log = logging.getLogger(__name__)
+
+
+class Character(object):
+    def __init__(self, name, script, voice, device=None, lang=main.LANG,
+            client=None, budget=512 * 2 ** 20):
+        self.name = name
+        self.script = script
+        self.device = device
+        self.lang = lang
+
+        directory = os.path.join(main.SOUND_DIR, name)
+        os.makedirs(directory, exist_ok=True)
+        self.cache = AudioCache(directory, budget)
+        self.tts = TTSService(client, self.cache, voice, lang,
+                ssml_template=main.SSML)
+        self.speak = functools.partial(main.synthesize_and_play,
+                tts=self.tts)
+        self.prepare = functools.partial(main.prepare, tts=self.tts)
+        self.warmup = Warmup(
+                functools.partial(main.pre_synthesize, tts=self.tts),
+                functools.partial(main.is_synthesized, tts=self.tts))
+        self.reader = None
+        self.journal = None
+        self.watcher = None
+        self.listener = None
+        self.session = None
+        self.listening = False
+        self._thread = None
+
+    def start(self, model, speech_client, stopped, tiers=main.TIERS,
+            speculation=True, gate=True, encoding='LINEAR16', watch=True,
+            max_alternatives=1, index_factory=main.VectorIndex):
+        """Starts listening with exact matching.
+
+        The semantic reader is built once the `model` future resolves.
+        """
+        self.journal = ScriptJournal(self.script,
+                main.ScriptReader._text_process)
+        exact = main.ScriptReader(self.script, self.speak, lang=self.lang,
+                warmup=self.warmup, tts=self.tts, journal=self.journal)
+
+        def load():
+            reader = main.W2VScriptReader(self.script, self.speak,
+                    lang=self.lang, model=model.result(),
+                    warmup=self.warmup, tts=self.tts, tiers=tiers,
+                    journal=self.journal, index_factory=index_factory)
+            if speculation:
+                reader = SpeculativeReader(reader, self.prepare)
+            return reader
+
+        self.reader = startup.LazyReader(exact, load)
+        if watch:
+            self.watcher = ScriptWatcher(self.script, self.reader.sync)
+        self.listener = main.Listener(self.reader,
+                main.COMMANDS.renamed(self.name), speaking=main.speaking)
+        self.session = RecognitionSession(lang=self.lang, add_noise=100,
+                client=speech_client, device=self.device,
+                pipeline=AudioPipeline(RATE, gate=gate, encoding=encoding),
+                max_alternatives=max_alternatives)
+        self._thread = threading.Thread(target=self._run, args=(stopped,),
+                name='character-' + self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self, stopped):
+        try:
+            with self.session:
+                self.listening = True
+                log.info("%s is listening", self.name)
+                while not stopped.is_set():
+                    try:
+                        self.session.recognize(self.listener)
+                    except main.StopIt:
+                        break
+        except Exception:
+            log.exception("%s stopped", self.name)
+        stopped.set()
+
+    def close(self):
+        log.info("%s: recognition %s, TTS %s", self.name,
+                self.session.stats() if self.listening else {},
+                self.tts.stats())
+        if self.reader.ready.is_set():
+            log.info("%s: matcher %s", self.name,
+                    self.reader.cascade.stats())
+            if isinstance(self.reader.reader, SpeculativeReader):
+                self.reader.shutdown()
+        self.warmup.shutdown()
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.journal.close()
+        self.cache.flush()
+
+
+def parse_character(spec):
+    parts = spec.split(':')
+    if not 3 <= len(parts) <= 4:
+        raise argparse.ArgumentTypeError(
+                "expected NAME:SCRIPT:VOICE[:DEVICE], got " + spec)
+    name, script, voice = parts[:3]
+    device = int(parts[3]) if len(parts) == 4 else None
+    return name, script, voice, device
+
+
+def run(args):
+    from google.cloud import speech
+    from google.cloud import texttospeech
+
+    main.TTS_CLIENT = texttospeech.TextToSpeechClient()
+    main.PLAYER = PlaybackEngine()
+    main.PLAYER.start()
+    speech_client = speech.SpeechClient()
+
+    def load_shared():
+        with startup.PROFILE.phase('shared model'):
+            if args.store:
+                return EmbeddingStore.load(args.store)
+            return load_model()
+
+    loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    model = loader.submit(load_shared)
+
+    characters = [Character(name, script, voice, device,
+                            client=main.TTS_CLIENT,
+                            budget=args.audio_budget * 2 ** 20)
+                  for name, script, voice, device in args.characters]
+
+    stopped = threading.Event()
+    for character in characters:
+        character.cache.prune()
+        character.start(model, speech_client, stopped,
+                tiers=args.tiers.split(','),
+                speculation=not args.no_speculation,
+                gate=not args.no_vad, encoding=args.stt_encoding,
+                watch=not args.no_watch,
+                max_alternatives=args.max_alternatives,
+                index_factory=main.make_index_factory(args.index, args.nprobe))
+
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        stopped.set()
+
+    for character in characters:
+        character.close()
+    loader.shutdown(wait=False)
+    main.PLAYER.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('characters', nargs='+', type=parse_character,
+            metavar='NAME:SCRIPT:VOICE[:DEVICE]')
+    parser.add_argument('--store',
+            help='Share a pruned embedding store instead of the model.')
+    parser.add_argument('--audio-budget', type=int, default=512,
+            help='Size limit of every character\'s sound directory in MB.')
+    parser.add_argument('--tiers', default=','.join(main.TIERS),
+            help='Comma separated matcher tiers, tried in this order.')
+    parser.add_argument('--no-speculation', action='store_true',
+            help='Only look up replies once the transcript is final.')
+    parser.add_argument('--index', choices=main.INDEXES, default='exact',
+            help='ivf is faster on large scripts but may miss the best line.')
+    parser.add_argument('--nprobe', type=int, default=8,
+            help='Lists the ivf index scans per query: lower is faster, '
+                 'but recall drops (0.62 measured at 4 on a real script).')
+    parser.add_argument('--max-alternatives', type=int, default=1,
+            help='Recognition alternatives to match per result.')
+    parser.add_argument('--no-watch', action='store_true',
+            help='Only reread scripts on "смени пластинку".')
+    parser.add_argument('--no-vad', action='store_true',
+            help='Stream all audio instead of only around speech.')
+    parser.add_argument('--stt-encoding', choices=sorted(ENCODINGS),
+            default='LINEAR16',
+            help='FLAC and OGG_OPUS need the soundfile package.')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(),
+            format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    run(args)
@@ -0,0 +1,173 @@
+"""Operator commands addressed to the bot by its wake word.
+
+Every registered command pattern is compiled into one regex, each inside
+its own named group, and the match is dispatched through a table:
+
+    COMMANDS = CommandRegistry(r'василиса')
+
+    @COMMANDS.command(r'\bдобавить(?P<phrase>.*)ответить(?P<response>.*)\b',
+                      final_only=True)
+    def add(listener, phrase, response):
+        ...
+
+The leftmost command in a transcript wins, ties go to the one registered
+first.  Commands marked `final_only` are skipped on interim transcripts.
+
+Example usage:
+    python commands.py --iterations 100000
+"""
+
+import argparse
+import re
+import time
+
+
+class Command(object):
+    def __init__(self, name, pattern, handler, final_only=False):
+        self.name = name
+        self.pattern = pattern
+        self.handler = handler
+        self.final_only = final_only
+        self.groups = re.compile(pattern).groupindex
+
+
+class CommandRegistry(object):
+    def __init__(self, wake=None, flags=re.I):
+        self.flags = flags
+        self.wake = re.compile(wake, flags) if wake else None
+        self.commands = []
+        self._regex = None
+
+    def register(self, pattern, handler, name=None, final_only=False):
+        name = name or handler.__name__
+        if any(c.name == name for c in self.commands):
+            raise ValueError("Command {} is already registered".format(name))
+        self.commands.append(Command(name, pattern, handler, final_only))
+        self._regex = None
+
+    def command(self, pattern, name=None, final_only=False):
+        """Decorator form of `register`."""
+        def decorator(handler):
+            self.register(pattern, handler, name, final_only)
+            return handler
+        return decorator
+
+    def renamed(self, wake):
+        """A registry with the same commands answering to `wake`."""
+        registry = CommandRegistry(wake, self.flags)
+        registry.commands = list(self.commands)
+        return registry
+
+    def unregister(self, name):
+        self.commands = [c for c in self.commands if c.name != name]
+        self._regex = None
+
+    def _compile(self):
+        # Named groups of the patterns are prefixed with the command index
+        # so that several commands may use the same names.
+        parts = []
+        for i, command in enumerate(self.commands):
+            pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<c{}_\1>'.format(i),
+                    command.pattern)
+            parts.append('(?P<c{}>{})'.format(i, pattern))
+        self._regex = re.compile('|'.join(parts) or '(?!)', self.flags)
+
+    def addressed(self, transcript):
+        """Whether `transcript` contains the wake word."""
+        return self.wake is None or bool(self.wake.search(transcript))
+
+    def match(self, transcript, is_final=False):
+        """Returns ``(command, arguments)`` or ``(None, None)``."""
+        if self._regex is None:
+            self._compile()
+        pos = 0
+        while pos <= len(transcript):
+            match = self._regex.search(transcript, pos)
+            if match is None:
+                break
+            i = int(match.lastgroup[1:])
+            command = self.commands[i]
+            if is_final or not command.final_only:
+                prefix = 'c{}_'.format(i)
+                return command, {name: match.group(prefix + name)
+                                 for name in command.groups}
+            pos = match.start() + 1
+        return None, None
+
+    def dispatch(self, listener, transcript, is_final=False):
+        """Runs the matching command, returns False if there is none."""
+        command, arguments = self.match(transcript, is_final)
+        if command is None:
+            return False
+        command.handler(listener, **arguments)
+        return True
+
+
+# The control phrases of main.Listener, for the benchmark.
+CONTROL_PHRASES = (
+    ('die', r'\bумри\b', False),
+    ('stop', r'\bхватит\b', False),
+    ('reload', r'\bсмени пластинку\b', False),
+    ('show', r'\bпокажи сценарий\b', False),
+    ('add', r'\bдобавить(?P<phrase>.*)ответить(?P<response>.*)\b', True),
+    ('remove', r'\bубрать команду(?P<phrase>.*)\b', True),
+)
+
+
+def chain(transcript, is_final):
+    """The former Listener chain of re.search calls."""
+    if not re.search(r'василиса', transcript, re.I):
+        return
+    for name, pattern, final_only in CONTROL_PHRASES:
+        match = re.search(pattern, transcript, re.I)
+        if match and (is_final or not final_only):
+            return name
+
+
+def benchmark(transcripts, iterations):
+    registry = CommandRegistry(r'василиса')
+    for name, pattern, final_only in CONTROL_PHRASES:
+        registry.register(pattern, None, name, final_only)
+
+    def compiled(transcript, is_final):
+        if not registry.addressed(transcript):
+            return
+        command, arguments = registry.match(transcript, is_final)
+        return command and command.name
+
+    for transcript, is_final in transcripts:
+        assert chain(transcript, is_final) == compiled(transcript, is_final)
+
+    for name, fn in (('chain', chain), ('compiled', compiled)):
+        t1 = time.perf_counter()
+        for _ in range(iterations):
+            for transcript, is_final in transcripts:
+                fn(transcript, is_final)
+        elapsed = time.perf_counter() - t1
+        print("{:<9} {:.2f}us per transcript".format(name,
+            elapsed / iterations / len(transcripts) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    transcripts = [
+        ('почему ты такая медленная', False),
+        ('тебя в детстве били', True),
+        ('василиса как дела', False),
+        ('василиса хватит', False),
+        ('василиса покажи сценарий', True),
+        ('василиса добавить привет ответить пока', False),
+        ('василиса добавить привет ответить пока', True),
+        ('василиса убрать команду привет', True),
+        ('василиса умри', True),
+    ]
+    benchmark(transcripts, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""On-disk cache of phrase vectors, so script reloads only embed the diff."""
+
+import hashlib
+import logging
+import os
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def model_identity(w2v):
+    """Cheap content fingerprint of a word vector model."""
+    h = hashlib.sha1()
+    keys = w2v.index_to_key
+    h.update('{}:{}:{}'.format(type(w2v).__name__, len(keys),
+        w2v.vector_size).encode('utf-8'))
+    for key in keys[:8] + keys[-8:]:
+        h.update(key.encode('utf-8'))
+        h.update(numpy.asarray(w2v[key], dtype=numpy.float32).tobytes())
+    return h.hexdigest()
+
+
+class EmbeddingCache(object):
+    """Phrase vectors keyed by sha1 of the model identity and the phrase.
+
+    The whole cache is one .npz file, read on first use and rewritten
+    atomically by `save` when anything changed.  A file written for
+    another model is ignored.
+    """
+    def __init__(self, filename, model_id):
+        self.filename = filename
+        self.model_id = model_id
+        self._vectors = None
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors = {}
+            self.load()
+        return self._vectors
+
+    def digest(self, phrase):
+        h = hashlib.sha1(self.model_id.encode('utf-8'))
+        h.update(b'\0')
+        h.update(phrase.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, phrase):
+        return self.vectors.get(self.digest(phrase))
+
+    def put(self, phrase, vec):
+        self.vectors[self.digest(phrase)] = numpy.asarray(vec,
+                dtype=numpy.float32)
+        self._dirty = True
+
+    def retain(self, phrases):
+        """Drops vectors of every phrase not in `phrases`."""
+        keep = set(self.digest(p) for p in phrases)
+        for digest in list(self.vectors):
+            if digest not in keep:
+                del self.vectors[digest]
+                self._dirty = True
+
+    def load(self):
+        try:
+            with numpy.load(self.filename) as npz:
+                if bytes(npz['model']).decode('ascii') != self.model_id:
+                    log.info("Embedding cache is for another model, ignoring")
+                    return
+                digests = bytes(npz['digests']).decode('ascii').split()
+                self._vectors = dict(zip(digests, npz['vectors']))
+        except (OSError, KeyError, ValueError):
+            return
+        self._dirty = False
+
+    def save(self):
+        if self._vectors is None or not self._dirty:
+            return
+        digests = list(self._vectors)
+        vectors = numpy.array([self._vectors[d] for d in digests],
+                dtype=numpy.float32)
+        tmp = self.filename + '.tmp.npz'
+        numpy.savez(tmp,
+                model=numpy.frombuffer(self.model_id.encode('ascii'),
+                    dtype=numpy.uint8),
+                digests=numpy.frombuffer(' '.join(digests).encode('ascii'),
+                    dtype=numpy.uint8),
+                vectors=vectors)
+        os.replace(tmp, self.filename)
+        self._dirty = False
@@ -0,0 +1,164 @@
+"""Vocabulary-pruned, quantized word vector store.
+
+W2VScriptReader only ever looks up `lemma_POS` keys, so the store keeps
+the keys reachable from the scripts plus the `top` most frequent model
+keys for live input, quantized to int8 with a per-vector scale (or to
+float16).  Cosine similarities computed from the store match the full
+model within TOLERANCE.
+
+Example usage:
+    python embedding_store.py build script-ru-RU.txt --top 50000
+    python embedding_store.py check
+"""
+
+import argparse
+import os
+
+import numpy
+
+STORE_FILE = os.path.join('model', 'store.npz')
+
+# Maximum absolute cosine similarity error against the full model.
+TOLERANCE = {
+    'int8': 0.01,
+    'float16': 0.001,
+}
+
+
+def quantize(vectors, dtype='int8'):
+    """Returns ``(data, scales)``, scales is None for float16."""
+    vectors = numpy.asarray(vectors, dtype=numpy.float32)
+    if dtype == 'float16':
+        return vectors.astype(numpy.float16), None
+    if dtype != 'int8':
+        raise ValueError("Unsupported store dtype {}".format(dtype))
+    scales = numpy.abs(vectors).max(axis=1) / 127.
+    scales[scales == 0] = 1.
+    data = numpy.round(vectors / scales[:, None]).astype(numpy.int8)
+    return data, scales.astype(numpy.float32)
+
+
+class EmbeddingStore(object):
+    """Read-only stand-in for gensim KeyedVectors.
+
+    Supports the parts W2VScriptReader uses: `vector_size`, `in` and
+    item lookup, which returns a float32 vector or raises KeyError.
+    """
+    def __init__(self, keys, data, scales=None):
+        self.index_to_key = list(keys)
+        self.key_to_index = {k: i for i, k in enumerate(self.index_to_key)}
+        self.data = data
+        self.scales = scales
+        self.vector_size = data.shape[1]
+
+    def __len__(self):
+        return len(self.index_to_key)
+
+    def __contains__(self, key):
+        return key in self.key_to_index
+
+    def __getitem__(self, key):
+        i = self.key_to_index[key]
+        vec = self.data[i].astype(numpy.float32)
+        if self.scales is not None:
+            vec *= self.scales[i]
+        return vec
+
+    @classmethod
+    def load(cls, filename=STORE_FILE):
+        with numpy.load(filename) as npz:
+            keys = bytes(npz['keys']).decode('utf-8').split('\n')
+            scales = npz['scales'] if 'scales' in npz.files else None
+            return cls(keys, npz['data'], scales)
+
+    def save(self, filename=STORE_FILE):
+        keys = numpy.frombuffer('\n'.join(self.index_to_key).encode('utf-8'),
+                dtype=numpy.uint8)
+        arrays = dict(keys=keys, data=self.data)
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        tmp = filename + '.tmp.npz'
+        numpy.savez(tmp, **arrays)
+        os.replace(tmp, filename)
+
+
+def script_keys(filenames):
+    """Yields the `lemma_POS` keys of every phrase in the scripts."""
+    from main import W2VScriptReader
+
+    for filename in filenames:
+        for phrase in W2VScriptReader.read_script(filename):
+            txt = W2VScriptReader._text_process(phrase, is_input=True,
+                    filter_stopwords=True)
+            for word in txt.split():
+                key = W2VScriptReader.word_key(word)
+                if key is not None:
+                    yield key
+
+
+def build(w2v, scripts, top=50000, dtype='int8'):
+    keys = list(w2v.index_to_key[:top])
+    seen = set(keys)
+    for key in script_keys(scripts):
+        if key in w2v.key_to_index and key not in seen:
+            seen.add(key)
+            keys.append(key)
+
+    data, scales = quantize(w2v[keys], dtype)
+    return EmbeddingStore(keys, data, scales)
+
+
+def check(store, w2v, pairs=10000, seed=0):
+    """Returns the maximum cosine similarity error over random key pairs."""
+    rng = numpy.random.default_rng(seed)
+    keys = store.index_to_key
+    a = rng.integers(len(keys), size=pairs)
+    b = rng.integers(len(keys), size=pairs)
+
+    def cosines(lookup):
+        x = numpy.array([lookup[keys[i]] for i in a], dtype=numpy.float32)
+        y = numpy.array([lookup[keys[i]] for i in b], dtype=numpy.float32)
+        x /= numpy.linalg.norm(x, axis=1)[:, None]
+        y /= numpy.linalg.norm(y, axis=1)[:, None]
+        return (x * y).sum(axis=1)
+
+    return float(numpy.abs(cosines(store) - cosines(w2v)).max())
+
+
+def main():
+    from model_cache import load_model
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', default=STORE_FILE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('scripts', nargs='+')
+    build_parser.add_argument('--top', type=int, default=50000,
+            help='How many of the most frequent model keys to keep.')
+    build_parser.add_argument('--dtype', choices=sorted(TOLERANCE),
+            default='int8')
+    subparsers.add_parser('check')
+    args = parser.parse_args()
+
+    w2v = load_model()
+    if args.command == 'build':
+        store = build(w2v, args.scripts, args.top, args.dtype)
+        store.save(args.store)
+        print("Stored {} of {} keys, {:.1f} MB instead of {:.1f} MB".format(
+            len(store), len(w2v.index_to_key), store.data.nbytes / 2. ** 20,
+            w2v.vectors.nbytes / 2. ** 20))
+    else:
+        store = EmbeddingStore.load(args.store)
+
+    dtype = 'int8' if store.scales is not None else 'float16'
+    error = check(store, w2v)
+    print("Max cosine error {:.4f}, tolerance {}".format(
+        error, TOLERANCE[dtype]))
+    if error > TOLERANCE[dtype]:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
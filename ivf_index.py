@@ -0,0 +1,229 @@
+"""Approximate cosine-similarity index with k-means coarse quantization.
+
+IVFIndex has the same interface as vector_index.VectorIndex, so it can be
+passed to W2VScriptReader as `index_factory`.  Vectors are split into
+`nlist` inverted lists around k-means centroids and a search only scans
+the `nprobe` lists closest to the query: raising `nprobe` trades latency
+for recall, `nprobe == nlist` is an exact scan.
+
+Recall depends on how tightly the phrase vectors cluster.  On synthetic
+topic clusters recall@1 stays at 1.0 from nprobe=4, but on a real 50k-line
+script it measured only 0.62 at nprobe=4, so the default is nprobe=8 and
+scripts that need exact matches should keep `--index exact` or check their
+own data with this benchmark before lowering it.
+
+Example usage:
+    python ivf_index.py --entries 300000 --nprobe 4 8 16
+"""
+
+import argparse
+import functools
+import time
+
+import numpy
+
+from vector_index import VectorIndex
+
+
+def kmeans(data, nlist, iterations=10, seed=0):
+    """Spherical k-means, returns unit-length centroids."""
+    rng = numpy.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = numpy.argmax(data.dot(centroids.T), axis=1)
+        for i in range(nlist):
+            members = data[assign == i]
+            if not len(members):
+                # Reseed empty clusters with a random point.
+                centroids[i] = data[rng.integers(len(data))]
+                continue
+            centroids[i] = VectorIndex.normalize(members.sum(axis=0))
+    return centroids
+
+
+class IVFIndex(object):
+    """Inverted-file index over unit-length vectors.
+
+    Until `min_train_size` vectors are added the index holds a single list
+    and searches are exact.  Once trained, new vectors go straight into the
+    list of their nearest centroid; the index retrains itself when it has
+    grown `retrain_factor` times since the last training.
+    """
+    def __init__(self, dim, capacity=64, nlist=None, nprobe=8,
+            min_train_size=4096, retrain_factor=4, dtype=numpy.float32):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+        self._dtype = dtype
+        self._centroids = None
+        self._trained_size = 0
+        self._lists = [VectorIndex(dim, capacity, dtype)]
+        self._where = {}
+
+    @classmethod
+    def with_options(cls, **kwargs):
+        """A subclass with `kwargs` as defaults, to use as `index_factory`."""
+        return type(cls.__name__, (cls,),
+                {'__init__': functools.partialmethod(cls.__init__, **kwargs)})
+
+    @classmethod
+    def from_matrix(cls, keys, matrix, **kwargs):
+        index = cls(matrix.shape[1], capacity=len(keys), dtype=matrix.dtype,
+                **kwargs)
+        for key, vec in zip(keys, matrix):
+            index.add(key, vec)
+        return index
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __iter__(self):
+        return iter(self._where)
+
+    def keys(self):
+        return list(self._where)
+
+    @property
+    def trained(self):
+        return self._centroids is not None
+
+    def _nearest_list(self, vec):
+        if self._centroids is None:
+            return 0
+        return int(numpy.argmax(self._centroids.dot(vec)))
+
+    def add(self, key, vec):
+        vec = VectorIndex.normalize(vec)
+        if key in self._where:
+            self.remove(key)
+        i = self._nearest_list(vec)
+        self._lists[i].add(key, vec)
+        self._where[key] = i
+
+        if len(self) >= self.min_train_size and \
+                len(self) >= self._trained_size * self.retrain_factor:
+            self.train()
+
+    def remove(self, key):
+        i = self._where.pop(key)
+        self._lists[i].remove(key)
+
+    def get(self, key):
+        return self._lists[self._where[key]].get(key)
+
+    def clear(self):
+        self._centroids = None
+        self._trained_size = 0
+        self._lists = [VectorIndex(self.dim, dtype=self._dtype)]
+        self._where = {}
+
+    def train(self, sample_size=65536, seed=0):
+        """(Re)builds the coarse quantizer from the vectors in the index."""
+        data = numpy.concatenate([l.matrix for l in self._lists])
+        keys = [k for l in self._lists for k in l]
+        nlist = self.nlist or max(1, int(numpy.sqrt(len(keys))))
+        nlist = min(nlist, len(keys))
+
+        rng = numpy.random.default_rng(seed)
+        sample = data
+        if len(data) > sample_size:
+            sample = data[rng.choice(len(data), sample_size, replace=False)]
+        self._centroids = kmeans(sample, nlist, seed=seed)
+
+        assign = numpy.argmax(data.dot(self._centroids.T), axis=1)
+        counts = numpy.bincount(assign, minlength=nlist)
+        self._lists = [VectorIndex(self.dim, int(c), self._dtype)
+                for c in counts]
+        for key, vec, i in zip(keys, data, assign):
+            self._lists[i].add(key, vec)
+            self._where[key] = int(i)
+        self._trained_size = len(keys)
+
+    def search(self, vec, k=1, nprobe=None):
+        """Returns up to `k` ``(similarity, key)`` pairs, best first."""
+        vec = VectorIndex.normalize(vec)
+        if self._centroids is None:
+            return self._lists[0].search(vec, k)
+
+        nprobe = min(nprobe or self.nprobe, len(self._lists))
+        scores = self._centroids.dot(vec)
+        if nprobe < len(self._lists):
+            probe = numpy.argpartition(-scores, nprobe - 1)[:nprobe]
+        else:
+            probe = range(len(self._lists))
+
+        found = []
+        for i in probe:
+            found.extend(self._lists[i].search(vec, k))
+        found.sort(key=lambda x: -x[0])
+        return found[:k]
+
+    def search_batch(self, vecs):
+        """Best ``(similarity, key)`` for every row of `vecs`, or None."""
+        if self._centroids is None:
+            return self._lists[0].search_batch(vecs)
+        return [(self.search(vec) or [None])[0] for vec in vecs]
+
+
+def recall_check(index, exact, queries, k=1, nprobe=None):
+    """Compares `index` against an exact `VectorIndex` over the same data.
+
+    Returns ``(recall, approx_seconds, exact_seconds)`` where recall is the
+    fraction of exact top-k keys also returned by the approximate search.
+    """
+    hits, approx_time, exact_time = 0, 0.0, 0.0
+    for vec in queries:
+        t1 = time.time()
+        approx = index.search(vec, k, nprobe=nprobe)
+        approx_time += time.time() - t1
+
+        t1 = time.time()
+        truth = exact.search(vec, k)
+        exact_time += time.time() - t1
+
+        hits += len(set(q for _, q in approx) & set(q for _, q in truth))
+    return (hits / float(len(queries) * k),
+            approx_time / len(queries), exact_time / len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=300000)
+    parser.add_argument('--dim', type=int, default=300)
+    parser.add_argument('--clusters', type=int, default=64,
+            help='Number of synthetic topics the data is drawn around.')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=1)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    topics = rng.standard_normal((args.clusters, args.dim))
+    def sample(n):
+        return topics[rng.integers(args.clusters, size=n)] + \
+                0.5 * rng.standard_normal((n, args.dim))
+
+    exact = VectorIndex(args.dim, capacity=args.entries)
+    index = IVFIndex(args.dim, capacity=args.entries)
+    for i, vec in enumerate(sample(args.entries)):
+        exact.add(i, vec)
+        index.add(i, vec)
+    queries = sample(args.queries)
+
+    for nprobe in args.nprobe:
+        recall, approx_time, exact_time = recall_check(
+                index, exact, queries, args.k, nprobe)
+        print("nprobe={:<4} recall@{}={:.3f}  ivf {:.3f} ms  exact {:.3f} ms"
+                .format(nprobe, args.k, recall,
+                        approx_time * 1000, exact_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Bounded LRU cache of surface word -> (lemma_POS key, vector)."""
+
+import collections
+import json
+import os
+import threading
+
+
+class LemmaCache(object):
+    """Remembers how words resolve, including words that do not.
+
+    A negative entry has a None vector, and a None key if pymorphy could
+    not map the word at all.  Only the word -> key mapping is persisted,
+    vectors are looked up from the model again on load.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, word):
+        return word in self._entries
+
+    def get(self, word):
+        """Returns ``(key, vec)`` or None if the word was never resolved."""
+        with self._lock:
+            entry = self._entries.get(word)
+            if entry is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self._entries.move_to_end(word)
+            return entry
+
+    def put(self, word, key, vec):
+        with self._lock:
+            self._entries[word] = (key, vec)
+            self._entries.move_to_end(word)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(total) if total else 0.,
+        }
+
+    def save(self, filename):
+        with self._lock:
+            data = [(w, k) for w, (k, v) in self._entries.items()]
+        with open(filename + '.tmp', 'w', encoding='utf-8') as fh:
+            json.dump(data, fh, ensure_ascii=False)
+        os.replace(filename + '.tmp', filename)
+
+    def load(self, filename, lookup):
+        """Restores entries, `lookup(key)` returns the vector or None."""
+        try:
+            with open(filename, encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return
+        for word, key in data[-self.maxsize:]:
+            self.put(word, key, lookup(key) if key is not None else None)
@@ -1,35 +1,87 @@
 
+import sys
+
+import startup
+if '--profile-startup' in sys.argv:
+    # Before the other imports, so that they are timed too.
+    startup.IMPORTS.install()
+
+import argparse
 import collections
-import hashlib
+import logging
 import os
 import re
-import sys
 import pprint
+import shutil
+import threading
+import time
 
 import numpy
 
-from nltk.corpus import stopwords
-from gensim.models import KeyedVectors
-import pymorphy2
-
-from synthesize_file import synthesize_text_file, synthesize_ssml_file
-from transcribe_streaming_mic import recognize_microphone_stream
+from synthesize_file import VOICE_NAME
+from transcribe_streaming_mic import RecognitionSession, RATE
+from vector_index import VectorIndex
+from ivf_index import IVFIndex
+from model_cache import load_model
+from embedding_store import EmbeddingStore
+from lemma_cache import LemmaCache
+from embedding_cache import EmbeddingCache, model_identity
+from script_bundle import bundle_path, load_bundle, source_digest, \
+        compile_bundle
+from script_store import ScriptStore
+from script_journal import MemoryJournal, ScriptJournal, ScriptWatcher
+from warmup import Warmup
+from audio_cache import AudioCache
+from playback import PlaybackEngine, ECHO_TAIL
+from speculative import SpeculativeReader
+from audio_pipeline import AudioPipeline, ENCODINGS
+from commands import CommandRegistry
+from segments import split_reply
+from tts_service import TTSService, LIVE, BACKGROUND
+from matcher import Cascade, ExactTier, LemmaTier, FuzzyTier, \
+        EmbeddingTier, TIERS, confidence_weights
+import metrics
+
+startup.PROFILE.add('import main', startup.STARTED, time.perf_counter())
+
+log = logging.getLogger(__name__)
 
 LANG='ru-RU'
 TTS_CLIENT = None
 
-synthesizer = synthesize_text_file
-
 SOUND_DIR='sound_dir'
+AUDIO_CACHE = AudioCache(SOUND_DIR)
+
+PLAYER = None
 
 if os.name == 'nt':
     import playsound
-    def play(filename):
+    def play_file(filename):
         playsound.playsound(filename)
 else:
-    def play(filename):
+    def play_file(filename):
         os.system("mpg123 {}".format(filename))
 
+# play_file() blocks, PLAYER keeps track of its own playback.
+_playing_file = threading.Event()
+_played_file_at = float('-inf')
+
+def play_blocking(filename):
+    global _played_file_at
+    _playing_file.set()
+    try:
+        play_file(filename)
+    finally:
+        _played_file_at = time.perf_counter()
+        _playing_file.clear()
+
+def speaking():
+    """Whether our own voice may be heard, only commands count then."""
+    if PLAYER is not None:
+        return PLAYER.audible
+    return _playing_file.is_set() or \
+            time.perf_counter() - _played_file_at < ECHO_TAIL
+
 SSML = """
 <?xml version="1.0"?>
 <speak version="1.1" xmlns="http://www.w3.org/2001/10/synthesis"
@@ -42,36 +94,111 @@ SSML = """
 """
 SSML = SSML.format(lang=LANG, TXT="{TXT}")
 
-def synthesize_and_play(txt):
-    txt_hash = hashlib.md5(txt.encode('utf-8')).hexdigest()
-    filename = os.path.join(SOUND_DIR, '{}.mp3'.format(txt_hash))
-    synthesizer = synthesize_text_file
-    if txt[0] == '<':
-        synthesizer = synthesize_ssml_file
-        txt = SSML.format(TXT=txt)
-        print(txt)
-    if not os.path.isfile(filename):
-        with open(filename, "wb") as fh:
-            synthesizer(txt, TTS_CLIENT, fh, lang=LANG)
-    play(filename)
+_tts = None
+
+def tts_service():
+    """The TTSService for the current TTS_CLIENT and AUDIO_CACHE."""
+    global _tts
+    if _tts is None or _tts.client is not TTS_CLIENT or \
+            _tts.cache is not AUDIO_CACHE:
+        _tts = TTSService(TTS_CLIENT, AUDIO_CACHE, VOICE_NAME, LANG,
+                ssml_template=SSML)
+    return _tts
+
+# The functions below use the default service unless given the `tts` of
+# another character, see characters.py.
+
+def audio_key(txt, ssml=None, tts=None):
+    return (tts or tts_service()).key(txt, ssml)
+
+def sound_filename(txt, ssml=None, tts=None):
+    tts = tts or tts_service()
+    return tts.cache.filename(tts.key(txt, ssml))
+
+def synthesize_segment(segment, priority=LIVE, tts=None):
+    """Returns a future of the segment's filename."""
+    return (tts or tts_service()).submit(segment.text, segment.ssml,
+            priority)
+
+def synthesize_segments(txt, priority=LIVE, tts=None):
+    """Starts all segments of `txt`, returns ``[(future, pause)]``."""
+    return [(synthesize_segment(segment, priority, tts), segment.pause)
+            for segment in split_reply(txt)]
+
+def synthesize_reply(txt, priority=LIVE, tts=None):
+    """Synthesizes every segment of `txt`, returns their filenames."""
+    return [future.result()
+            for future, pause in synthesize_segments(txt, priority, tts)]
+
+def pre_synthesize(txt, tts=None):
+    """Warm-up renders behind everything live."""
+    return synthesize_reply(txt, BACKGROUND, tts)
+
+def reply_keys(txt, tts=None):
+    return [audio_key(segment.text, segment.ssml, tts)
+            for segment in split_reply(txt)]
+
+def synthesize_and_play(txt, tts=None):
+    segments = synthesize_segments(txt, tts=tts)
+    if PLAYER is None:
+        for future, pause in segments:
+            play_blocking(future.result())
+            time.sleep(pause)
+        return
+    # The first segment starts playing while the rest are in flight.
+    sources = []
+    for future, pause in segments:
+        sources.append(future)
+        if pause:
+            sources.append(float(pause))
+    PLAYER.play_all(sources)
+
+def prepare(txt, tts=None, stop=None, ready=None):
+    """Gets `txt` ready to play without playing it.
+
+    Gives up between segments, or while one is being synthesized, once
+    the `stop` event is set.  `ready()` is called as soon as the first
+    segment could start playing.
+    """
+    for future, pause in synthesize_segments(txt, tts=tts):
+        while stop is not None and not future.done():
+            if stop.wait(0.05):
+                return
+        filename = future.result()
+        if stop is not None and stop.is_set():
+            return
+        if PLAYER is not None:
+            PLAYER.prefetch(filename)
+        if ready is not None:
+            ready()
+            ready = None
+
+def is_synthesized(txt, tts=None):
+    cache = (tts or tts_service()).cache
+    return all(key in cache for key in reply_keys(txt, tts))
 
 class ScriptReader(object):
-    def __init__(self, filename, callback, lang=LANG):
+    def __init__(self, filename, callback, lang=LANG, warmup=None, tts=None,
+            journal=None):
+        # Edits may come from the ScriptWatcher thread and lookups from a
+        # SpeculativeReader worker, the script and its indexes change only
+        # under the lock.
+        self._lock = threading.RLock()
         self.filename = filename
         self.callback = callback
         self.lang = LANG
+        self.warmup = warmup
+        self.tts = tts
+        self.script = ScriptStore()
+        # Voice edits only reach the script file through a ScriptJournal,
+        # readers of the same script should share it.
+        self.journal = journal or MemoryJournal()
 
         self.update()
 
     def save_script(self):
-        with open(self.filename + '.tmp', 'w', encoding='utf-8') as fh:
-            for q, a in self.script.items():
-                fh.write(q + '\n')
-                fh.write(a + '\n')
-                fh.write('\n')
-        os.unlink(self.filename)
-        os.rename(self.filename + '.tmp', self.filename)
-
+        # Voice edits are journaled as they are made.
+        self.journal.compact()
 
     @classmethod
     def _text_process(cls, txt, is_input=False):
@@ -84,58 +211,138 @@ class ScriptReader(object):
 
     @classmethod
     def read_script(cls, filename):
-        script = collections.OrderedDict()
-
         with open(filename, encoding='utf-8') as fh:
-            it = iter(fh)
-            try:
-                while True:
-                    k = cls._text_process(next(it), is_input=True)
-                    if not k:
-                        continue
-                    v = cls._text_process(next(it))
-                    if not v:
-                        continue
-                    script[k] = v
-            except StopIteration:
-                pass
+            return cls.parse_script(fh)
+
+    @classmethod
+    def parse_script(cls, lines):
+        script = ScriptStore()
+
+        it = iter(lines)
+        try:
+            while True:
+                k = cls._text_process(next(it), is_input=True)
+                if not k:
+                    continue
+                v = cls._text_process(next(it))
+                if not v:
+                    continue
+                script[k] = v
+        except StopIteration:
+            pass
 
         return script
 
+    def read(self):
+        """The script file with the journaled edits applied."""
+        return self.journal.replay(self.read_script(self.filename))
+
+    def reply_keys(self, reply):
+        """The audio cache keys of the segments of `reply`."""
+        return reply_keys(reply, self.tts)
+
+    def warm_up(self, replies=None):
+        # Replies of the current script are never evicted from the cache.
+        pin = replies is None
+        if replies is None:
+            replies = list(self.script.values())
+        cache = (self.tts or tts_service()).cache
+        keys = {r: self.reply_keys(r) for r in replies if r}
+        cache.pin((key for ks in keys.values() for key in ks), replace=pin)
+
+        if self.warmup is not None:
+            self.warmup.submit([r for r, ks in keys.items()
+                                if not all(key in cache for key in ks)])
+
     def update(self):
-        self.script = self.read_script(self.filename)
+        with self._lock:
+            # In place, lines that did not change keep their entry ids.
+            self.script.reset(self.read().items())
+            self.warm_up()
+
+    def sync(self):
+        """Applies the lines changed in the script file since it was read."""
+        with self._lock:
+            script = self.read()
+            removed = [key for key in self.script if key not in script]
+            changed = [(key, value) for key, value in script.items()
+                       if self.script.get(key) != value]
+            for key in removed:
+                self._remove(key)
+            for key, value in changed:
+                self._add(key, value)
+            if removed or changed:
+                log.info("Script changed: %d lines added or changed, "
+                        "%d removed", len(changed), len(removed))
+                self.warm_up([value for key, value in changed])
+
+    def _add(self, key, value):
+        self.script[key] = value
+
+    def _remove(self, key):
+        del self.script[key]
 
     def add(self, key, value):
-        key = self._text_process(key, is_input=True)
-        value = self._text_process(value)
+        with self._lock:
+            key = self._text_process(key, is_input=True)
+            value = self._text_process(value)
 
-        self.script[key] = value
+            self.journal.add(key, value)
+            self._add(key, value)
+            self.warm_up([value])
 
     def remove(self, key):
-        key = self._text_process(key, is_input=True)
-        if key in self.script:
-            del self.script[key]
+        with self._lock:
+            key = self._text_process(key, is_input=True)
+            if key in self.script:
+                self.journal.remove(key)
+                self._remove(key)
 
     def __call__(self, transcript, is_final=False):
-        transcript = self._text_process(transcript, is_input=True)
+        with metrics.span('normalize'):
+            transcript = self._text_process(transcript, is_input=True)
 
-        replica = self.script.get(transcript)
+        with self._lock:
+            with metrics.span('match.exact'):
+                replica = self.script.get(transcript)
 
-        if not replica and is_final:
-            replica = self.script.get('ничего непонятно')
+            if not replica and is_final:
+                replica = self.script.get('ничего непонятно')
 
         if not replica:
             return
 
-        print("Got {}, respond with {}".format(transcript, replica))
+        log.info("Got %s, respond with %s", transcript, replica)
 
         self.callback(replica)
 
         return True
 
+    def respond(self, alternatives, is_final=False):
+        """Replies to `alternatives`, ``(transcript, confidence)`` pairs."""
+        for transcript, confidence in alternatives:
+            if self(transcript, is_final):
+                return True
+
+INDEXES = ('exact', 'ivf')
+
+
+def make_index_factory(index='exact', nprobe=8):
+    """Returns the `index_factory` for W2VScriptReader.
+
+    'ivf' scans only `nprobe` k-means lists per query: much faster on large
+    scripts, but it may miss the best line, see ivf_index.py.
+    """
+    if index == 'ivf':
+        return IVFIndex.with_options(nprobe=nprobe)
+    return VectorIndex
+
+
 class W2VScriptReader(ScriptReader):
-    stopwords = stopwords.words('russian')
-    pymorphy = pymorphy2.MorphAnalyzer()
+    # Loaded on first use by load_morphology(), they take a while.
+    stopwords = None
+    pymorphy = None
+    _morphology_lock = threading.Lock()
 
     grammar_map_POS_TAGS = {
         'NOUN': '_NOUN',
@@ -145,13 +352,48 @@ class W2VScriptReader(ScriptReader):
         'PRED': '_ADP',
     }
 
+    # Any class with the VectorIndex interface, e.g. ivf_index.IVFIndex
+    # for scripts too large for an exact scan.
+    index_factory = VectorIndex
+
+    lemma_cache_size = 10000
+
+    # Matcher tiers in the order they are tried, see matcher.py.
+    tiers = TIERS
+    fuzzy_threshold = 0.7
+
     def __init__(self, *args, **kwargs):
-        print("Loading word2vec...")
-        self.w2v = KeyedVectors.load_word2vec_format('model/model.bin',
-                binary=True, encoding='utf-8')
-        print("done")
+        self.load_morphology()
+        self.index_factory = kwargs.pop('index_factory', self.index_factory)
+        self.cascade = self.make_cascade(kwargs.pop('tiers', self.tiers))
+        self.lemmas = LemmaCache(
+                kwargs.pop('lemma_cache_size', self.lemma_cache_size))
+        self.phrases = None
+        self.vectors = None
+        self.bundle = None
+
+        self.w2v = kwargs.pop('model', None)
+        if self.w2v is None:
+            log.info("Loading word2vec...")
+            with startup.PROFILE.phase('word2vec'):
+                self.w2v = load_model()
+            log.info("done")
 
         super(W2VScriptReader, self).__init__(*args, **kwargs)
+        # Compaction rewrites the script file, which the bundle is keyed on.
+        self.journal.compacted.append(self.refresh_bundle)
+
+    @classmethod
+    def load_morphology(cls):
+        with cls._morphology_lock:
+            if cls.pymorphy is not None:
+                return
+            with startup.PROFILE.phase('morphology'):
+                from nltk.corpus import stopwords
+                import pymorphy2
+
+                cls.stopwords = frozenset(stopwords.words('russian'))
+                cls.pymorphy = pymorphy2.MorphAnalyzer()
 
     @classmethod
     def _text_process(cls, txt, is_input=False, filter_stopwords=False):
@@ -162,93 +404,271 @@ class W2VScriptReader(ScriptReader):
         txt = re.sub("ё", "е", txt)
         txt = re.sub("[.,;:?!]", "", txt)
         if filter_stopwords:
+            cls.load_morphology()
             txt = " ".join(x for x in txt.split() if x not in cls.stopwords)
         return txt
 
     def update_vecs(self):
-        self.vectors = collections.OrderedDict()
-        for key, value in self.script.items():
-            self.add_vector_item(key, value)
+        if self.vectors is None:
+            self.vectors = self.index_factory(self.w2v.vector_size,
+                    capacity=len(self.script))
+        # Only the lines that changed since the last update are embedded.
+        # The index is keyed by entry id, see script_store.py.
+        for i in self.vectors.keys():
+            if not self.script.has_id(i):
+                self.vectors.remove(i)
+        for entry in self.script.entries():
+            if entry.id not in self.vectors:
+                self.add_vector_item(entry.key, entry.reply)
+        self.phrases.retain(self.script.key(i) for i in self.vectors.keys())
+        self.phrases.save()
 
     def to_vector(self, txt):
+        with metrics.span('embed'):
+            return self._to_vector(txt)
+
+    def _to_vector(self, txt):
         total = numpy.zeros((self.w2v.vector_size,))
         txt = self._text_process(txt, is_input=True, filter_stopwords=True)
 
         words = txt.split()
         nwords = 0
         for word in words:
-            parse = self.pymorphy.parse(word)[0]
-            POS = parse.tag.POS
-            if POS is None:
-                print("dont know word", word)
-                continue
-            print(word, parse, POS)
-            POS = self.grammar_map_POS_TAGS.get(POS)
-            if POS is None:
-                print("can't map word", word)
-                continue
-            word = parse.normal_form
-            try:
-                vec = self.w2v[word + POS]
+            key, vec = self.word_vector(word)
+            if vec is not None:
                 total += vec
                 nwords += 1
-            except KeyError:
-                print("no word ", word + POS)
         return total / numpy.sqrt(numpy.dot(total, total) + 0.0001)
 
+    def _model_vector(self, key):
+        try:
+            return self.w2v[key]
+        except KeyError:
+            return None
+
+    def word_vector(self, word):
+        """Returns ``(lemma_POS, vector)``, either may be None."""
+        entry = self.lemmas.get(word)
+        if entry is not None:
+            return entry
+        key = self.word_key(word)
+        vec = None
+        if key is not None:
+            vec = self._model_vector(key)
+            if vec is None:
+                log.debug("no word %s", key)
+        self.lemmas.put(word, key, vec)
+        return key, vec
+
+    @classmethod
+    def word_key(cls, word):
+        cls.load_morphology()
+        parse = cls.pymorphy.parse(word)[0]
+        POS = parse.tag.POS
+        if POS is None:
+            log.debug("dont know word %s", word)
+            return
+        POS = cls.grammar_map_POS_TAGS.get(POS)
+        if POS is None:
+            log.debug("can't map word %s", word)
+            return
+        return parse.normal_form + POS
+
+    def lemma_key(self, txt):
+        """Sorted lemmas of the significant words of `txt`."""
+        txt = self._text_process(txt, is_input=True, filter_stopwords=True)
+        lemmas = []
+        for word in txt.split():
+            key, vec = self.word_vector(word)
+            lemmas.append(key or word)
+        return ' '.join(sorted(lemmas))
+
+    def make_cascade(self, names):
+        factories = {
+            'exact': ExactTier,
+            'lemma': lambda: LemmaTier(self.lemma_key),
+            'fuzzy': lambda: FuzzyTier(self.fuzzy_threshold),
+            'embedding': lambda: EmbeddingTier(self._nearest_key,
+                                               self.lookup_batch),
+        }
+        return Cascade(factories[name]() for name in names)
+
+    def _nearest_key(self, txt):
+        found = self.lookup(txt)
+        if found:
+            return found[1]
+
+    def phrase_vector(self, key):
+        vec = self.phrases.get(key)
+        if vec is None:
+            vec = self.to_vector(key)
+            self.phrases.put(key, vec)
+        return vec
+
+    def phrase_vectors(self, keys):
+        """The phrase vectors of `keys` as a matrix, one row per key."""
+        with self._lock:
+            vectors = [self.phrase_vector(key) for key in keys]
+        return numpy.array(vectors, dtype=numpy.float32).reshape(
+                len(keys), self.w2v.vector_size)
+
     def add_vector_item(self, key, value):
         if key == 'default':
             return
-        vec = self.to_vector(key)
-        self.vectors[key] = (vec, key, value)
+        self.vectors.add(self.script.id(key), self.phrase_vector(key))
 
-    def lookup(self, key):
+    def lookup(self, key, k=1):
         lookup = self.to_vector(key)
-        mindistance, element = float('+inf'), None
-        for i, (vec, q, a) in enumerate(self.vectors.values()):
-            d = lookup - vec
-            distance = numpy.sqrt(numpy.dot(d, d))
-            print(distance, q)
-            if distance < mindistance:
-                mindistance = distance
-                element = (vec, q, a)
-        print(mindistance, element[1], element[2])
-        return element
+        with metrics.span('lookup'):
+            found = self.vectors.search(lookup, k)
+        if not found:
+            return
+        elements = [(self.vectors.get(i), self.script.key(i),
+                     self.script.reply(i))
+                for similarity, i in found]
+        log.debug("%s %s %s", found[0][0], elements[0][1], elements[0][2])
+        if k == 1:
+            return elements[0]
+        return elements
+
+    def lookup_batch(self, texts):
+        """Nearest ``(similarity, key)`` of every text, or None."""
+        vecs = numpy.array([self.to_vector(txt) for txt in texts])
+        with metrics.span('lookup'):
+            found = self.vectors.search_batch(vecs)
+        return [best and (best[0], self.script.key(best[1])) for best in found]
+
+    @property
+    def lemmas_filename(self):
+        return self.filename + '.lemmas'
+
+    @property
+    def phrases_filename(self):
+        return self.filename + '.vectors.npz'
 
-    def update(self):
-        super(W2VScriptReader, self).update()
-        self.update_vecs()
+    def save_script(self):
+        # Compaction refreshes the bundle, which takes the lock itself.
+        super(W2VScriptReader, self).save_script()
+        with self._lock:
+            self.lemmas.save(self.lemmas_filename)
+            self.phrases.save()
+
+    def _start_from_bundle(self):
+        bundle = load_bundle(bundle_path(self.filename),
+                source_digest(self.filename), self.phrases.model_id)
+        if bundle is None:
+            return False
+        self.bundle = bundle
+        self.script = bundle.script
+        self.vectors = self.index_factory.from_matrix(
+                [self.script.id(key) for key in bundle.keys], bundle.vectors)
+        log.info("Started from %s", bundle.path)
+        return True
 
-    def add(self, key, value):
-        key = self._text_process(key, is_input=True)
-        value = self._text_process(value)
+    def reply_keys(self, reply):
+        if self.bundle is not None:
+            tts = self.tts or tts_service()
+            keys = self.bundle.audio(tts.voice, tts.lang).get(reply)
+            if keys is not None:
+                return keys
+        return super(W2VScriptReader, self).reply_keys(reply)
+
+    def refresh_bundle(self):
+        """Recompiles the bundle, if there is one, for the script file as
+        it is now."""
+        if not os.path.isdir(bundle_path(self.filename)):
+            return
+        entries = compile_bundle(self)
+        log.info("Refreshed %s, %d entries", bundle_path(self.filename),
+                entries)
 
+    def update(self):
+        with self._lock:
+            stale = False
+            if self.phrases is None:
+                self.lemmas.load(self.lemmas_filename, self._model_vector)
+                self.phrases = EmbeddingCache(self.phrases_filename,
+                        model_identity(self.w2v))
+                if self._start_from_bundle():
+                    self.cascade.build(self.script)
+                    if self.journal.records():
+                        self.sync()
+                    self.warm_up()
+                    return
+                stale = True
+            super(W2VScriptReader, self).update()
+            self.update_vecs()
+            self.cascade.build(self.script)
+            log.info("Lemma cache: %s", self.lemmas.stats())
+        if stale:
+            # E.g. compacted before this reader was there to refresh it.
+            self.refresh_bundle()
+
+    def _add(self, key, value):
+        new = key not in self.script
         self.script[key] = value
-        self.add_vector_item(key, value)
-
-    def remove(self, key):
-        key = self._text_process(key, is_input=True)
-        self.script.pop(key)
-        self.vectors.pop(key)
+        if new:
+            self.add_vector_item(key, value)
+            self.cascade.add(key)
+
+    def _remove(self, key):
+        i = self.script.id(key)
+        del self.script[key]
+        if i in self.vectors:
+            self.vectors.remove(i)
+        self.cascade.remove(key)
+
+    def resolve(self, transcript, is_final=False):
+        """Returns the reply for `transcript` without calling back."""
+        with metrics.span('normalize'):
+            txt = self._text_process(transcript, is_input=True)
+
+        with self._lock:
+            key, tier = self.cascade.match(txt, is_final)
+            if key is not None:
+                return self.script[key]
+
+            if is_final:
+                return self.script.get('default')
+
+    def resolve_batch(self, alternatives, is_final=False):
+        """Returns ``(transcript, reply)`` for the best of `alternatives`.
+
+        All ``(transcript, confidence)`` pairs of a result go through the
+        matcher together, so the embedding tier scores them in one pass.
+        """
+        with metrics.span('normalize'):
+            texts = [self._text_process(transcript, is_input=True)
+                    for transcript, confidence in alternatives]
+        weights = confidence_weights(
+                [confidence for transcript, confidence in alternatives])
+
+        with self._lock:
+            i, key, tier = self.cascade.match_batch(texts, weights, is_final)
+            if key is not None:
+                return alternatives[i][0], self.script[key]
+
+            if is_final and alternatives:
+                return alternatives[0][0], self.script.get('default')
+            return None, None
 
     def __call__(self, transcript, is_final=False):
-        exact = self._text_process(transcript, is_input=True)
-
-        replica = self.script.get(exact)
-        if not replica and not is_final:
+        replica = self.resolve(transcript, is_final)
+        if not replica:
             return
 
-        if is_final:
-            clear = self._text_process(transcript, is_input=True,
-                    filter_stopwords=True)
-            replica = self.lookup(clear)
-            if replica:
-                replica = replica[2]
+        log.info("Got %s, respond with %s", transcript, replica)
+
+        self.callback(replica)
+
+        return True
 
+    def respond(self, alternatives, is_final=False):
+        transcript, replica = self.resolve_batch(alternatives, is_final)
         if not replica:
-            replica = self.script.get('default')
+            return
 
-        print("Got {}, respond with {}".format(transcript, replica))
+        log.info("Got %s, respond with %s", transcript, replica)
 
         self.callback(replica)
 
@@ -257,11 +677,53 @@ class W2VScriptReader(ScriptReader):
 class StopIt(Exception):
     pass
 
+# Operator commands, see commands.py.  Register more with
+# @COMMANDS.command(pattern) before the Listener starts.
+COMMANDS = CommandRegistry(r'василиса')
+
+@COMMANDS.command(r'\bумри\b')
+def die(listener):
+    log.info('Exiting..')
+    listener.reader.save_script()
+    raise StopIt()
+
+@COMMANDS.command(r'\bхватит\b')
+def stop(listener):
+    if PLAYER is not None:
+        PLAYER.stop()
+
+@COMMANDS.command(r'\bсмени пластинку\b')
+def reload(listener):
+    log.info('Updating..')
+    listener.reader.update()
+
+@COMMANDS.command(r'\bпокажи сценарий\b')
+def show(listener):
+    pprint.pprint(collections.OrderedDict(listener.reader.script.items()))
+
+@COMMANDS.command(r'\bдобавить(?P<phrase>.*)ответить(?P<response>.*)\b',
+        final_only=True)
+def add(listener, phrase, response):
+    listener.reader.add(phrase, response)
+
+@COMMANDS.command(r'\bубрать команду(?P<phrase>.*)\b', final_only=True)
+def remove(listener, phrase):
+    listener.reader.remove(phrase)
+
 class Listener(object):
-    def __init__(self, reader):
+    """Answers lines and runs commands from streaming responses.
+
+    While `speaking()` the microphone hears our own reply, so only commands
+    addressed to the bot, e.g. "хватит", are run until the end of that
+    utterance.
+    """
+    def __init__(self, reader, commands=COMMANDS, speaking=None):
         self.reader = reader
+        self.commands = commands
+        self.speaking = speaking
 
     def __call__(self, responses):
+        overheard = False
         for response in responses:
             if not response.results:
                 continue
@@ -280,68 +742,167 @@ class Listener(object):
                     #return
                 #continue
 
+            if self.speaking is not None and self.speaking():
+                overheard = True
+
+            # Lines are matched over all alternatives at once, commands
+            # addressed to Vasilisa are handled first.
+            alternatives = []
             for alternative in result.alternatives:
                 transcript = alternative.transcript
 
-                print(transcript, result.is_final)
+                log.debug("%s %s", transcript, result.is_final)
 
-                if not re.search(r'василиса', transcript, re.I):
-                    if self.reader(transcript, result.is_final):
-                        # Force it to reconnect
-                        return
+                if not self.commands.addressed(transcript):
+                    alternatives.append((transcript, alternative.confidence))
                     continue
 
-                if re.search(r'\bумри\b', transcript, re.I):
-                    print('Exiting..')
-                    self.reader.save_script()
-                    raise StopIt()
-
-                if re.search(r'\bсмени пластинку\b', transcript, re.I):
-                    print('Updating..')
-                    self.reader.update()
-                    return
-
-                if re.search(r'\bпокажи сценарий\b', transcript, re.I):
-                    pprint.pprint(self.reader.script)
-                    return
-
-                match = re.search( r'\bдобавить(?P<phrase>.*)ответить(?P<response>.*)\b', transcript, re.I)
-                if result.is_final and match:
-                    self.reader.add(match['phrase'], match['response'])
+                if self.commands.dispatch(self, transcript, result.is_final):
                     return
 
-                match = re.search(r'\bубрать команду(?P<phrase>.*)\b',
-                        transcript, re.I)
-                if result.is_final and match:
-                    self.reader.remove(match['phrase'])
-                    return
+            if alternatives and not overheard and self.reader.respond(
+                    alternatives, result.is_final):
+                # Start a new streaming request for the next line
+                return
 
             if result.is_final:
                 return
 
 
 def main():
-    global TTS_CLIENT
-    from google.cloud import texttospeech
-    TTS_CLIENT = texttospeech.TextToSpeechClient()
-
-    try:
-        filename = sys.argv[1]
-    except IndexError:
-        filename = 'script-%s.txt' % LANG
-
-    script_reader = W2VScriptReader(
-            filename,
-            synthesize_and_play,
-            lang=LANG)
-
-    listener = Listener(script_reader)
-
-    while True:
-        try:
-            recognize_microphone_stream(listener, lang=LANG, add_noise=100)
-        except StopIt:
-            break
+    global TTS_CLIENT, PLAYER
+    parser = argparse.ArgumentParser()
+    parser.add_argument('script', nargs='?', default='script-%s.txt' % LANG)
+    parser.add_argument('--store',
+            help='Use a pruned embedding store, see embedding_store.py.')
+    parser.add_argument('--audio-budget', type=int, default=512,
+            help='Size limit of %s in megabytes.' % SOUND_DIR)
+    parser.add_argument('--external-player', action='store_true',
+            help='Play every reply with playsound/mpg123 instead.')
+    parser.add_argument('--no-speculation', action='store_true',
+            help='Only look up replies once the transcript is final.')
+    parser.add_argument('--tiers', default=','.join(TIERS),
+            help='Comma separated matcher tiers, tried in this order.')
+    parser.add_argument('--index', choices=INDEXES, default='exact',
+            help='ivf is faster on large scripts but may miss the best line.')
+    parser.add_argument('--nprobe', type=int, default=8,
+            help='Lists the ivf index scans per query: lower is faster, '
+                 'but recall drops (0.62 measured at 4 on a real script).')
+    parser.add_argument('--max-alternatives', type=int, default=1,
+            help='Recognition alternatives to match per result.')
+    parser.add_argument('--no-watch', action='store_true',
+            help='Only reread the script on "смени пластинку".')
+    parser.add_argument('--no-vad', action='store_true',
+            help='Stream all audio instead of only around speech.')
+    parser.add_argument('--stt-encoding', choices=sorted(ENCODINGS),
+            default='LINEAR16',
+            help='FLAC and OGG_OPUS need the soundfile package.')
+    parser.add_argument('--log-level', default='INFO',
+            help='DEBUG shows every transcript and lookup, '
+                 'WARNING silences per-utterance logs.')
+    parser.add_argument('--metrics-file',
+            help='Append per-stage latency histograms to a JSON-lines file.')
+    parser.add_argument('--metrics-port', type=int,
+            help='Serve per-stage latency histograms on localhost.')
+    parser.add_argument('--profile-startup', action='store_true',
+            help='Log import and startup phase times once the semantic '
+                 'reader is up.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(),
+            format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.metrics_file:
+        metrics.METRICS.export_jsonl(args.metrics_file)
+    if args.metrics_port:
+        metrics.METRICS.serve(args.metrics_port)
+
+    with startup.PROFILE.phase('tts client'):
+        from google.cloud import texttospeech
+        TTS_CLIENT = texttospeech.TextToSpeechClient()
+
+    if not args.external_player and shutil.which('mpg123') is None:
+        # PlaybackEngine decodes the MP3 replies with mpg123.
+        log.warning("mpg123 not found, playing replies with the external "
+                "player")
+        args.external_player = True
+
+    if not args.external_player:
+        with startup.PROFILE.phase('playback'):
+            PLAYER = PlaybackEngine()
+            PLAYER.start()
+
+    with startup.PROFILE.phase('audio cache'):
+        AUDIO_CACHE.budget = args.audio_budget * 2 ** 20
+        AUDIO_CACHE.prune()
+
+    warmup = Warmup(pre_synthesize, is_synthesized)
+
+    # Exact matching answers right away, the semantic reader takes over
+    # once the model and morphology are loaded.
+    journal = ScriptJournal(args.script, ScriptReader._text_process)
+    with startup.PROFILE.phase('exact reader'):
+        exact_reader = ScriptReader(args.script, synthesize_and_play,
+                lang=LANG, warmup=warmup, journal=journal)
+
+    def load_reader():
+        model = None
+        if args.store:
+            with startup.PROFILE.phase('embedding store'):
+                model = EmbeddingStore.load(args.store)
+        reader = W2VScriptReader(
+                args.script,
+                synthesize_and_play,
+                lang=LANG,
+                model=model,
+                warmup=warmup,
+                journal=journal,
+                tiers=args.tiers.split(','),
+                index_factory=make_index_factory(args.index, args.nprobe))
+        if not args.no_speculation:
+            reader = SpeculativeReader(reader, prepare)
+        return reader
+
+    def on_ready(reader):
+        if args.profile_startup:
+            startup.IMPORTS.uninstall()
+            log.info("Startup profile:\n%s", startup.PROFILE.report())
+
+    script_reader = startup.LazyReader(exact_reader, load_reader, on_ready)
+
+    watcher = None
+    if not args.no_watch:
+        watcher = ScriptWatcher(args.script, script_reader.sync)
+    listener = Listener(script_reader, speaking=speaking)
+
+    pipeline = AudioPipeline(RATE, gate=not args.no_vad,
+            encoding=args.stt_encoding)
+
+    with RecognitionSession(lang=LANG, add_noise=100, pipeline=pipeline,
+            max_alternatives=args.max_alternatives) as session:
+        startup.PROFILE.mark('listening')
+        log.info("Listening")
+        while True:
+            try:
+                session.recognize(listener)
+            except StopIt:
+                break
+    log.info("Recognition: %s", session.stats())
+    if script_reader.ready.is_set():
+        log.info("Matcher: %s", script_reader.cascade.stats())
+    log.info("TTS: %s", tts_service().stats())
+
+    warmup.shutdown()
+    if watcher is not None:
+        watcher.stop()
+    journal.close()
+    if script_reader.ready.is_set() and not args.no_speculation:
+        log.info("Speculation: %s", script_reader.stats())
+        script_reader.shutdown()
+    AUDIO_CACHE.flush()
+    if PLAYER is not None:
+        PLAYER.close()
+    if args.metrics_file:
+        metrics.METRICS.write_jsonl(args.metrics_file)
 
 if __name__ == '__main__':
     main()
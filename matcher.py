@@ -0,0 +1,338 @@
+"""Tiered transcript matching, cheapest tier first.
+
+A Cascade asks its tiers in order and stops at the first one that decides:
+
+    exact      the normalized transcript is a script line
+    lemma      same bag of lemmas, so word order, stop words and case
+               endings do not matter
+    fuzzy      character trigram similarity above a threshold
+    embedding  nearest script line by word2vec, always decides
+
+Every tier reports whether it decided and how long it took, so the
+embedding tier only runs for the lines the cheap tiers could not place.
+
+`Cascade.match_batch` takes all recognition alternatives of a result at
+once; the first tier that decides any of them picks the best one by its
+score weighted with the STT confidence.
+"""
+
+import collections
+import logging
+import time
+
+import numpy
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+TIERS = ('exact', 'lemma', 'fuzzy', 'embedding')
+
+
+def confidence_weights(confidences, floor=0.5):
+    """Maps STT confidences to score weights in [floor, 1].
+
+    Streaming results usually only carry a confidence for the first
+    alternative; when none has one they all weigh the same.
+    """
+    if not any(confidences):
+        return [1.] * len(confidences)
+    return [floor + (1. - floor) * c for c in confidences]
+
+
+class Tier(object):
+    """Maps normalized text to a script key, or None if it can't decide."""
+    name = None
+    # Tiers that may mistake a partial transcript for a line only run on
+    # final transcripts.
+    final_only = False
+
+    def build(self, script):
+        self.script = script
+
+    def add(self, key):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def match(self, text):
+        raise NotImplementedError
+
+    def score_batch(self, texts):
+        """``(score, key)`` for every text, key is None if undecided."""
+        return [(1., key) if key is not None else (0., None)
+                for key in map(self.match, texts)]
+
+
+class ExactTier(Tier):
+    name = 'exact'
+
+    def match(self, text):
+        if text in self.script:
+            return text
+
+
+class LemmaTier(Tier):
+    """Exact match on `lemma_key(text)`, e.g. sorted lemmas."""
+    name = 'lemma'
+
+    def __init__(self, lemma_key):
+        self.lemma_key = lemma_key
+        # lemmas -> the lines sharing them, the first one is matched.
+        self._keys = {}
+        self._lemmas = {}
+
+    def build(self, script):
+        super(LemmaTier, self).build(script)
+        self._keys = {}
+        self._lemmas = {}
+        for key in script:
+            self.add(key)
+
+    def add(self, key):
+        if key in self._lemmas:
+            return
+        lemmas = self.lemma_key(key)
+        self._lemmas[key] = lemmas
+        if lemmas:
+            self._keys.setdefault(lemmas, []).append(key)
+
+    def remove(self, key):
+        lemmas = self._lemmas.pop(key, None)
+        if not lemmas:
+            return
+        keys = self._keys[lemmas]
+        keys.remove(key)
+        if not keys:
+            del self._keys[lemmas]
+
+    def match(self, text):
+        lemmas = self.lemma_key(text)
+        if lemmas:
+            keys = self._keys.get(lemmas)
+            if keys:
+                return keys[0]
+
+
+def trigrams(text):
+    """Character trigrams of every word padded with spaces."""
+    grams = set()
+    for word in text.split():
+        word = ' ' + word + ' '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class FuzzyTier(Tier):
+    """Dice coefficient over word trigram sets via an inverted index.
+
+    Sets ignore word order and a changed ending only costs a trigram or
+    two, while unrelated lines share almost none.  Posting lists are id
+    arrays, so a batch of texts is counted against every line with a
+    single bincount; adding or removing a line only touches the posting
+    lists of its own trigrams.
+    """
+    name = 'fuzzy'
+    final_only = True
+
+    def __init__(self, threshold=0.7):
+        self.threshold = threshold
+        self.build({})
+
+    def build(self, script):
+        super(FuzzyTier, self).build(script)
+        self._keys = []
+        self._ids = {}
+        self._free = []
+        index = collections.defaultdict(list)
+        sizes = []
+        for key in script:
+            grams = trigrams(key)
+            self._ids[key] = len(self._keys)
+            self._keys.append(key)
+            sizes.append(len(grams))
+            for gram in grams:
+                index[gram].append(self._ids[key])
+        self._postings = {gram: numpy.array(ids, dtype=numpy.intp)
+                          for gram, ids in index.items()}
+        self._sizes = numpy.array(sizes, dtype=float)
+
+    def add(self, key):
+        self.remove(key)
+        grams = trigrams(key)
+        if self._free:
+            i = self._free.pop()
+            self._keys[i] = key
+        else:
+            i = len(self._keys)
+            self._keys.append(key)
+            if i == len(self._sizes):
+                self._sizes = numpy.concatenate(
+                        [self._sizes, numpy.zeros(max(i, 16))])
+        self._sizes[i] = len(grams)
+        self._ids[key] = i
+        for gram in grams:
+            ids = self._postings.get(gram)
+            if ids is None:
+                self._postings[gram] = numpy.array([i], dtype=numpy.intp)
+            else:
+                self._postings[gram] = numpy.append(ids, i)
+
+    def remove(self, key):
+        i = self._ids.pop(key, None)
+        if i is None:
+            return
+        for gram in trigrams(key):
+            ids = self._postings[gram]
+            ids = ids[ids != i]
+            if len(ids):
+                self._postings[gram] = ids
+            else:
+                del self._postings[gram]
+        self._keys[i] = None
+        self._sizes[i] = 0
+        self._free.append(i)
+
+    def scores(self, texts):
+        """Dice coefficients, one row per text and a column per line id."""
+        postings = self._postings
+        n = len(self._keys)
+        sizes = self._sizes[:n]
+        hits = [numpy.zeros(0, dtype=numpy.intp)]
+        lengths = numpy.zeros((len(texts), 1))
+        for j, text in enumerate(texts):
+            grams = trigrams(text)
+            lengths[j] = len(grams)
+            hits.extend(postings[gram] + j * n for gram in grams
+                    if gram in postings)
+        common = numpy.bincount(numpy.concatenate(hits),
+                minlength=len(texts) * n).reshape(len(texts), n)
+        return 2. * common / numpy.maximum(lengths + sizes, 1.)
+
+    def score(self, text):
+        """Returns ``(score, key)`` of the most similar line."""
+        return self.score_batch([text], 0.)[0]
+
+    def match(self, text):
+        score, key = self.score(text)
+        if score >= self.threshold:
+            return key
+
+    def score_batch(self, texts, threshold=None):
+        if threshold is None:
+            threshold = self.threshold
+        if not self._ids:
+            return [(0., None)] * len(texts)
+        scores = self.scores(texts)
+        found = []
+        for row, i in zip(scores, numpy.argmax(scores, axis=1)):
+            score = float(row[i])
+            if score > 0. and score >= threshold:
+                found.append((score, self._keys[i]))
+            else:
+                found.append((0., None))
+        return found
+
+
+class EmbeddingTier(Tier):
+    """Nearest line by `search(text)`; the index is kept by the reader.
+
+    `search_batch(texts)` returns ``(similarity, key)`` or None for each
+    text, scoring them all in one pass.
+    """
+    name = 'embedding'
+    final_only = True
+
+    def __init__(self, search, search_batch=None):
+        self.search = search
+        self.search_batch = search_batch
+
+    def match(self, text):
+        return self.search(text)
+
+    def score_batch(self, texts):
+        if self.search_batch is None:
+            return super(EmbeddingTier, self).score_batch(texts)
+        return [found or (0., None) for found in self.search_batch(texts)]
+
+
+class Cascade(object):
+    def __init__(self, tiers, skip=('default',)):
+        self.tiers = list(tiers)
+        self.skip = set(skip)
+        self.decided = collections.Counter()
+        self.undecided = 0
+        # [(tier name, decided, seconds)] of the last match.
+        self.last = []
+
+    def build(self, script):
+        for tier in self.tiers:
+            tier.build(script)
+            for key in self.skip:
+                tier.remove(key)
+
+    def add(self, key):
+        if key not in self.skip:
+            for tier in self.tiers:
+                tier.add(key)
+
+    def remove(self, key):
+        for tier in self.tiers:
+            tier.remove(key)
+
+    def match(self, text, is_final=False):
+        """Returns ``(key, tier name)``, key is None if no tier decided."""
+        self.last = []
+        for tier in self.tiers:
+            if tier.final_only and not is_final:
+                continue
+            t1 = time.perf_counter()
+            key = tier.match(text)
+            elapsed = time.perf_counter() - t1
+            metrics.observe('match.' + tier.name, elapsed)
+            decided = key is not None and key not in self.skip
+            self.last.append((tier.name, decided, elapsed))
+            if decided:
+                log.debug("%s: %r -> %r in %.2fms", tier.name, text, key,
+                        elapsed * 1000)
+                self.decided[tier.name] += 1
+                return key, tier.name
+        if is_final:
+            self.undecided += 1
+        return None, None
+
+    def match_batch(self, texts, weights=None, is_final=False):
+        """Returns ``(index, key, tier name)`` of the best of `texts`.
+
+        Index and key are None if no tier decided any of them.
+        """
+        if weights is None:
+            weights = [1.] * len(texts)
+        self.last = []
+        for tier in self.tiers:
+            if tier.final_only and not is_final:
+                continue
+            t1 = time.perf_counter()
+            scored = tier.score_batch(texts)
+            elapsed = time.perf_counter() - t1
+            metrics.observe('match.' + tier.name, elapsed)
+            candidates = [(score * weight, -i, key)
+                    for i, ((score, key), weight)
+                    in enumerate(zip(scored, weights))
+                    if key is not None and key not in self.skip]
+            self.last.append((tier.name, bool(candidates), elapsed))
+            if candidates:
+                score, i, key = max(candidates)
+                log.debug("%s: %r -> %r (%.3f) in %.2fms", tier.name,
+                        texts[-i], key, score, elapsed * 1000)
+                self.decided[tier.name] += 1
+                return -i, key, tier.name
+        if is_final:
+            self.undecided += 1
+        return None, None, None
+
+    def stats(self):
+        stats = {tier.name: self.decided[tier.name] for tier in self.tiers}
+        stats['undecided'] = self.undecided
+        return stats
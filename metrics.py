@@ -0,0 +1,147 @@
+"""Lightweight latency instrumentation.
+
+Stages are timed with `span`, or reported with `observe`, into rolling
+histograms holding the last `window` samples each.  Snapshots can be
+appended to a JSON-lines file periodically or served as plain text over
+HTTP on localhost:
+
+    with metrics.span('lookup'):
+        ...
+
+    metrics.METRICS.export_jsonl('metrics.jsonl', interval=10)
+    metrics.METRICS.serve(9100)   # curl localhost:9100
+"""
+
+import contextlib
+import http.server
+import json
+import logging
+import threading
+import time
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+class Histogram(object):
+    """Keeps the last `window` samples in a ring."""
+    def __init__(self, window=1024):
+        self._samples = numpy.zeros(window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.
+
+    def observe(self, value):
+        with self._lock:
+            self._samples[self.count % len(self._samples)] = value
+            self.count += 1
+            self.total += value
+
+    def summary(self):
+        with self._lock:
+            samples = self._samples[:min(self.count, len(self._samples))]
+            samples = samples.copy()
+            count, total = self.count, self.total
+        if not count:
+            return {'count': 0}
+        p50, p90, p99 = numpy.percentile(samples, [50, 90, 99])
+        return {
+            'count': count,
+            'mean': total / count,
+            'p50': p50,
+            'p90': p90,
+            'p99': p99,
+            'max': samples.max(),
+        }
+
+
+class Metrics(object):
+    def __init__(self, window=1024):
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name,
+                        Histogram(self.window))
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t1)
+
+    def snapshot(self):
+        # observe() may add stages from other threads meanwhile.
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {name: histograms[name].summary()
+                for name in sorted(histograms)}
+
+    def text(self):
+        """One line per stage, times in milliseconds."""
+        lines = []
+        for name, s in self.snapshot().items():
+            if not s['count']:
+                continue
+            lines.append("{} count={} mean={:.3f} p50={:.3f} p90={:.3f} "
+                    "p99={:.3f} max={:.3f}".format(name, s['count'],
+                        s['mean'] * 1000, s['p50'] * 1000, s['p90'] * 1000,
+                        s['p99'] * 1000, s['max'] * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def write_jsonl(self, filename):
+        with open(filename, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps({'time': time.time(),
+                                 'stages': self.snapshot()}) + '\n')
+
+    def export_jsonl(self, filename, interval=10.):
+        """Appends a snapshot to `filename` every `interval` seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_jsonl(filename)
+                except Exception:
+                    log.exception("Can't export metrics to %s", filename)
+        thread = threading.Thread(target=run, name='metrics-jsonl',
+                daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves `text()` over HTTP from a daemon thread."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                name='metrics-http', daemon=True)
+        thread.start()
+        return server
+
+
+METRICS = Metrics()
+
+span = METRICS.span
+observe = METRICS.observe
@@ -0,0 +1,81 @@
+"""Converts the word2vec model into gensim's native layout for mmap loading.
+
+Parsing the word2vec binary format takes tens of seconds and keeps a
+private copy of every vector.  The native layout stores the vectors as a
+plain .npy file next to the pickled vocabulary, so later starts map it
+read-only: startup is near-instant and every bot process on the machine
+shares the same page cache.
+
+Example usage:
+    python model_cache.py
+    python model_cache.py --source model/model.bin --cache model/model.kv
+"""
+
+import argparse
+import glob
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+MODEL_FILE = os.path.join('model', 'model.bin')
+CACHE_FILE = os.path.join('model', 'model.kv')
+
+
+def is_fresh(source=MODEL_FILE, cache=CACHE_FILE):
+    if not os.path.isfile(cache):
+        return False
+    if not os.path.isfile(source):
+        return True
+    return os.path.getmtime(cache) >= os.path.getmtime(source)
+
+
+def convert(source=MODEL_FILE, cache=CACHE_FILE):
+    """Writes `source` in the native layout, returns the loaded vectors."""
+    from gensim.models import KeyedVectors
+
+    t1 = time.time()
+    w2v = KeyedVectors.load_word2vec_format(source, binary=True,
+            encoding='utf-8')
+    log.info("Parsed %s in %.1fs", source, time.time() - t1)
+
+    # Always store the vector array separately so it can be mmapped.
+    tmp = cache + '.tmp'
+    w2v.save(tmp, sep_limit=0)
+    # The pickle is renamed last, it is what is_fresh() looks at.
+    for path in sorted(glob.glob(glob.escape(tmp) + '.*')) + [tmp]:
+        os.replace(path, cache + path[len(tmp):])
+    return w2v
+
+
+def load_model(source=MODEL_FILE, cache=CACHE_FILE):
+    """Loads the model, converting it on the first run."""
+    from gensim.models import KeyedVectors
+
+    if not is_fresh(source, cache):
+        log.info("Converting %s to %s...", source, cache)
+        try:
+            convert(source, cache)
+        except OSError as e:
+            log.warning("Can't write model cache: %s", e)
+            return KeyedVectors.load_word2vec_format(source, binary=True,
+                    encoding='utf-8')
+
+    return KeyedVectors.load(cache, mmap='r')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default=MODEL_FILE,
+            help='The word2vec binary model.')
+    parser.add_argument('--cache', default=CACHE_FILE,
+            help='Where to write the native model.')
+    args = parser.parse_args()
+
+    convert(args.source, args.cache)
+    t1 = time.time()
+    load_model(args.source, args.cache)
+    print("Loads in {:.3f}s".format(time.time() - t1))
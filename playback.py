@@ -0,0 +1,234 @@
+"""In-process audio playback through one long-lived PyAudio output stream.
+
+Replies are decoded to 16-bit mono PCM once and kept in a bounded LRU
+cache, so replaying a hot reply costs only the writes to the already open
+stream.  Playback runs on its own thread fed by a queue; `stop` cuts the
+current reply short and drops everything queued behind it.
+
+The queue also takes futures of filenames and pauses, so the segments of
+a long reply can be queued while they are still being synthesized and
+play back to back as soon as each one is ready.
+
+`play` returns right away, so the microphone keeps recording while a
+reply plays.  `audible` tells main.Listener to only run commands then.
+"""
+
+import collections
+import logging
+import queue
+import subprocess
+import threading
+import time
+import wave
+
+import numpy
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Google TTS renders MP3 at 24 kHz.
+RATE = 24000
+CHUNK = 1024  # frames per write, ~40ms
+# Seconds the speakers may still be heard after the last write: the
+# device buffer and the room echo.
+ECHO_TAIL = 0.3
+
+
+def resample(pcm, rate, to_rate):
+    """Linear resampling of int16 mono samples."""
+    if rate == to_rate or not len(pcm):
+        return pcm
+    n = int(len(pcm) * to_rate / rate)
+    x = numpy.linspace(0, len(pcm) - 1, n)
+    return numpy.interp(x, numpy.arange(len(pcm)), pcm).astype(numpy.int16)
+
+
+def decode_wav(filename, rate=RATE):
+    with wave.open(filename, 'rb') as w:
+        if w.getsampwidth() != 2:
+            raise ValueError("{}: only 16-bit WAV is supported".format(
+                filename))
+        pcm = numpy.frombuffer(w.readframes(w.getnframes()),
+                dtype=numpy.int16)
+        channels, file_rate = w.getnchannels(), w.getframerate()
+    if channels > 1:
+        pcm = pcm.reshape(-1, channels).mean(axis=1).astype(numpy.int16)
+    return resample(pcm, file_rate, rate).tobytes()
+
+
+def decode_mp3(filename, rate=RATE):
+    """Decodes with mpg123 into raw signed 16-bit mono at `rate`."""
+    return subprocess.run(
+            ['mpg123', '-q', '-s', '-m', '-r', str(rate), filename],
+            stdout=subprocess.PIPE, check=True).stdout
+
+
+def decode(filename, rate=RATE):
+    if filename.endswith('.wav'):
+        return decode_wav(filename, rate)
+    return decode_mp3(filename, rate)
+
+
+class PCMCache(object):
+    """LRU of decoded PCM bounded by total bytes."""
+    def __init__(self, budget=64 * 2 ** 20, decoder=decode, rate=RATE):
+        self.budget = budget
+        self.decoder = decoder
+        self.rate = rate
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def get(self, filename):
+        with self._lock:
+            pcm = self._entries.get(filename)
+            if pcm is not None:
+                self._entries.move_to_end(filename)
+                return pcm
+
+        with metrics.span('decode'):
+            pcm = self.decoder(filename, self.rate)
+
+        with self._lock:
+            if filename not in self._entries:
+                self._entries[filename] = pcm
+                self.size += len(pcm)
+            while self.size > self.budget and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+        return pcm
+
+
+class PlaybackEngine(object):
+    def __init__(self, rate=RATE, chunk=CHUNK, cache=None,
+            echo_tail=ECHO_TAIL):
+        self.rate = rate
+        self.chunk = chunk
+        self.echo_tail = echo_tail
+        self.cache = cache or PCMCache(rate=rate)
+        self._queue = queue.Queue()
+        self._put_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._idle_at = float('-inf')
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        import pyaudio
+
+        self._audio_interface = pyaudio.PyAudio()
+        self._audio_stream = self._audio_interface.open(
+            format=pyaudio.paInt16, channels=1, rate=self.rate,
+            output=True, frames_per_buffer=self.chunk)
+        self._thread = threading.Thread(target=self._run, name='playback',
+                daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.stop()
+        self._queue.put(None)
+        self._thread.join()
+        self._audio_stream.stop_stream()
+        self._audio_stream.close()
+        self._audio_interface.terminate()
+
+    @property
+    def playing(self):
+        return not self._idle.is_set()
+
+    @property
+    def audible(self):
+        """Whether the microphone may pick up our own voice."""
+        return self.playing or \
+                time.perf_counter() - self._idle_at < self.echo_tail
+
+    def prefetch(self, filename):
+        """Decodes `filename` into the PCM cache ahead of playback."""
+        self.cache.get(filename)
+
+    def play(self, filename):
+        """Queues `filename`, or a future of it, returns immediately."""
+        self.play_all([filename])
+
+    def pause(self, seconds):
+        """Queues `seconds` of silence."""
+        self.play_all([float(seconds)])
+
+    def play_all(self, sources):
+        """Queues filenames, futures or pauses in seconds back to back.
+
+        Nothing queued from another thread gets in between, so replies of
+        several characters never interleave.
+        """
+        with self._put_lock:
+            self._idle.clear()
+            # Time to first audio is measured at the first item that is
+            # not a pause.
+            queued = time.perf_counter()
+            for source in sources:
+                if isinstance(source, (int, float)):
+                    self._queue.put((float(source), None))
+                    continue
+                self._queue.put((source, queued))
+                queued = None
+
+    def stop(self):
+        """Cuts the current reply short and drops the queued ones."""
+        with self._put_lock:
+            self._stop.set()
+            try:
+                while True:
+                    if self._queue.get(block=False) is None:
+                        # Keep the shutdown request.
+                        self._queue.put(None)
+                        break
+            except queue.Empty:
+                pass
+
+    def wait(self, timeout=None):
+        return self._idle.wait(timeout)
+
+    def _pcm(self, source):
+        if isinstance(source, float):
+            return bytes(int(source * self.rate) * 2)
+        if hasattr(source, 'result'):
+            source = source.result()
+        if self._stop.is_set():
+            return b''
+        return self.cache.get(source)
+
+    def _run(self):
+        step = self.chunk * 2
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            source, queued = item
+            self._stop.clear()
+            try:
+                pcm = memoryview(self._pcm(source))
+            except Exception as e:
+                log.warning("Can't play %s: %s", source, e)
+                pcm = memoryview(b'')
+            for i in range(0, len(pcm), step):
+                if self._stop.is_set():
+                    break
+                self._audio_stream.write(pcm[i:i + step].tobytes())
+                if not i and queued is not None:
+                    metrics.observe('playback.start',
+                            time.perf_counter() - queued)
+            if self._queue.empty():
+                self._idle_at = time.perf_counter()
+                self._idle.set()
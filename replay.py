@@ -0,0 +1,310 @@
+"""Offline replay of a show through Listener, with local STT/TTS stand-ins.
+
+Streaming recognition responses are either read from a JSON-lines file,
+one utterance per line as a list of responses:
+
+    [{"results": [{"is_final": false, "alternatives": [{"transcript": "..."}]}]},
+     {"results": [{"is_final": true, "alternatives": [{"transcript": "...",
+                                                       "confidence": 0.9}]}]}]
+
+or generated from the script itself, word by word.  TTS goes to a fake
+client that returns deterministic audio after `--tts-delay` seconds, audio
+is cached in a temporary directory and main.PLAYER is a NullPlayer, so
+replies go through main.synthesize_and_play, TTSService and the player
+queue like live ones, but the harness needs neither a microphone, a
+sound card, credentials nor network.  At the end it prints per-stage
+latency percentiles, followed by the matcher stages recorded in
+metrics.METRICS.
+
+Example usage:
+    python replay.py script-ru-RU.txt
+    python replay.py script-ru-RU.txt --responses show.jsonl --w2v
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import tempfile
+import threading
+import time
+
+import main
+import metrics
+from audio_cache import AudioCache
+
+# metrics.METRICS stages reported after the replay's own.
+MATCH_STAGES = ('normalize', 'embed', 'lookup', 'match.')
+
+
+class Alternative(object):
+    def __init__(self, transcript, confidence=0.):
+        self.transcript = transcript
+        self.confidence = confidence
+
+
+class Result(object):
+    def __init__(self, alternatives, is_final=False, stability=0.):
+        self.alternatives = alternatives
+        self.is_final = is_final
+        self.stability = stability
+
+
+class Response(object):
+    def __init__(self, results):
+        self.results = results
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([Result([Alternative(**a) for a in r['alternatives']],
+                           r.get('is_final', False), r.get('stability', 0.))
+                    for r in data.get('results', [])])
+
+
+def read_responses(filename):
+    with open(filename, encoding='utf-8') as fh:
+        for line in fh:
+            if line.strip():
+                yield [Response.from_json(r) for r in json.loads(line)]
+
+
+def synthetic_responses(script):
+    """One utterance per script line: growing interims, then the final."""
+    for phrase in script:
+        if phrase == 'default':
+            continue
+        words = phrase.split()
+        utterance = [Response([Result([Alternative(' '.join(words[:i]))])])
+                for i in range(1, len(words))]
+        utterance.append(Response([Result([Alternative(phrase, 0.9)],
+            is_final=True)]))
+        yield utterance
+
+
+class FakeAudioContent(object):
+    def __init__(self, audio_content):
+        self.audio_content = audio_content
+
+
+class FakeTTSClient(object):
+    """Stands in for texttospeech.TextToSpeechClient."""
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = 0
+
+    def synthesize_speech(self, input_text, voice, audio_config):
+        self.calls += 1
+        time.sleep(self.delay)
+        text = input_text.text or input_text.ssml
+        return FakeAudioContent(hashlib.sha1(text.encode('utf-8')).digest()
+                * 64)
+
+
+class NullPlayer(object):
+    """PlaybackEngine stand-in that plays nothing.
+
+    Records when every reply was queued and when it would have started
+    playing, that is when its first segment was synthesized.
+    """
+    def __init__(self):
+        self.queued = []
+        # (started, queued) of every reply, in the order they started.
+        self.started = []
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @property
+    def playing(self):
+        with self._lock:
+            return bool(self._pending)
+
+    audible = playing
+
+    def play(self, filename):
+        self.play_all([filename])
+
+    def pause(self, seconds):
+        self.play_all([float(seconds)])
+
+    def play_all(self, sources):
+        queued = time.time()
+        self.queued.append(queued)
+        futures = [source for source in sources if hasattr(source, 'result')]
+        first = next((source for source in sources
+                      if not isinstance(source, (int, float))), None)
+        if first is None:
+            return
+        if first not in futures:
+            self.started.append((queued, queued))
+        else:
+            def started(future):
+                with self._lock:
+                    self.started.append((time.time(), queued))
+            first.add_done_callback(started)
+        with self._lock:
+            self._pending.update(futures)
+        for future in futures:
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self, timeout=None):
+        """Waits until every queued reply is synthesized."""
+        with self._lock:
+            pending = list(self._pending)
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        return not not_done
+
+    def prefetch(self, filename):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Stages(object):
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def report(self, summaries=None):
+        """Prints the stages, then the `summaries` of metrics.Metrics."""
+        row = "{:<18} {:>6} {:>9.2f} {:>9.2f} {:>9.2f}"
+        print("{:<18} {:>6} {:>9} {:>9} {:>9}".format(
+            'stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms'))
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            def percentile(p):
+                return samples[min(len(samples) - 1, int(p * len(samples)))]
+            print(row.format(stage, len(samples), percentile(0.5) * 1000,
+                percentile(0.9) * 1000, percentile(0.99) * 1000))
+        for stage, s in (summaries or {}).items():
+            if s['count']:
+                print(row.format(stage, s['count'], s['p50'] * 1000,
+                    s['p90'] * 1000, s['p99'] * 1000))
+
+
+class TimedReader(object):
+    """Times the reader, replies are only queued on the NullPlayer."""
+    def __init__(self, reader, stages):
+        self.reader = reader
+        self.stages = stages
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def _timed(self, call, is_final, *args):
+        t1 = time.time()
+        replied = call(*args)
+        self.stages.add('final' if is_final else 'interim', time.time() - t1)
+        return replied
+
+    def __call__(self, transcript, is_final=False):
+        return self._timed(self.reader, is_final, transcript, is_final)
+
+    def respond(self, alternatives, is_final=False):
+        return self._timed(self.reader.respond, is_final, alternatives,
+                is_final)
+
+
+def replay(listener, utterances, stages, player):
+    for utterance in utterances:
+        final_at = [None]
+
+        def responses():
+            for response in utterance:
+                if any(r.is_final for r in response.results):
+                    final_at[0] = time.time()
+                yield response
+
+        queued = len(player.queued)
+        t1 = time.time()
+        try:
+            listener(responses())
+        except main.StopIt:
+            break
+        stages.add('utterance', time.time() - t1)
+        player.wait()
+        if len(player.queued) == queued:
+            continue
+        started, queued_at = player.started[-1]
+        stages.add('queue->play', started - queued_at)
+        if final_at[0] is not None:
+            stages.add('final->play', started - final_at[0])
+
+
+def build_reader(args):
+    respond = main.synthesize_and_play
+    if not args.w2v:
+        return main.ScriptReader(args.script, respond, lang=main.LANG)
+    model = None
+    if args.store:
+        model = main.EmbeddingStore.load(args.store)
+    reader = main.W2VScriptReader(args.script, respond, lang=main.LANG,
+            model=model, tiers=args.tiers.split(','))
+    if args.speculation:
+        reader = main.SpeculativeReader(reader, main.prepare)
+    return reader
+
+
+def run(args):
+    stages = Stages()
+    player = NullPlayer()
+    main.PLAYER = player
+    main.TTS_CLIENT = FakeTTSClient(args.tts_delay)
+    main.AUDIO_CACHE = AudioCache(tempfile.mkdtemp(prefix='replay-'))
+
+    reader = build_reader(args)
+
+    listener = main.Listener(TimedReader(reader, stages))
+
+    if args.responses:
+        utterances = list(read_responses(args.responses))
+    else:
+        utterances = list(synthetic_responses(reader.script))
+
+    t1 = time.time()
+    for _ in range(args.repeat):
+        replay(listener, utterances, stages, player)
+    elapsed = time.time() - t1
+
+    print()
+    print("Replayed {} utterances x {} in {:.2f}s, {} TTS calls".format(
+        len(utterances), args.repeat, elapsed, main.TTS_CLIENT.calls))
+    stages.report({stage: s
+                   for stage, s in metrics.METRICS.snapshot().items()
+                   if stage.startswith(MATCH_STAGES)})
+    print("TTS:", main.tts_service().stats())
+    if args.w2v:
+        print("Matcher:", reader.cascade.stats())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', nargs='?',
+            default='script-%s.txt' % main.LANG)
+    parser.add_argument('--responses',
+            help='Recorded responses, one utterance per JSON line.')
+    parser.add_argument('--w2v', action='store_true',
+            help='Use W2VScriptReader, needs the word2vec model.')
+    parser.add_argument('--store',
+            help='Use a pruned embedding store with --w2v.')
+    parser.add_argument('--tiers', default=','.join(main.TIERS),
+            help='Matcher tiers for --w2v, tried in this order.')
+    parser.add_argument('--speculation', action='store_true',
+            help='Wrap the reader in SpeculativeReader (with --w2v).')
+    parser.add_argument('--tts-delay', type=float, default=0.2,
+            help='Seconds the fake TTS client takes per request.')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Replays of the show, later ones hit the audio cache.')
+    run(parser.parse_args())
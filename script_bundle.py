@@ -0,0 +1,175 @@
+"""Compiles a script file into a bundle the bot can start from instantly.
+
+A bundle is a directory next to the script holding:
+
+    manifest.json   version, source/model fingerprints, audio manifest
+    strings.json    normalized keys and their replies, in script order
+    vectors.npy     phrase embedding matrix, one row per key but 'default'
+
+W2VScriptReader maps vectors.npy copy-on-write at startup and falls back
+to the text file when the bundle is stale.  The audio manifest lists the
+audio cache keys of every reply's segments, for the voice the bundle was
+compiled with: the reader pins them and queues the missing replies for
+warm-up without splitting every reply again.  It recompiles an existing
+bundle whenever voice edits are compacted into the script file, so they
+do not make the next start a cold one.  With --audio missing replies are
+rendered into the audio cache as well.
+
+Example usage:
+    python script_bundle.py script-ru-RU.txt
+    python script_bundle.py script-ru-RU.txt --audio
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy
+
+from embedding_cache import model_identity
+from script_store import ScriptStore
+
+log = logging.getLogger(__name__)
+
+BUNDLE_VERSION = 3
+
+
+def bundle_path(script_filename):
+    return script_filename + '.bundle'
+
+
+def source_digest(script_filename):
+    with open(script_filename, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+class Bundle(object):
+    def __init__(self, path, manifest, script, keys, vectors):
+        self.path = path
+        self.manifest = manifest
+        self.script = script
+        self.keys = keys
+        self.vectors = vectors
+
+    def audio(self, voice, lang):
+        """Maps reply text to its segments' audio cache keys, empty if the
+        bundle was compiled for another voice."""
+        if self.manifest.get('voice') != [voice, lang]:
+            return {}
+        return self.manifest.get('audio', {})
+
+
+def write_bundle(path, source, model_id, script, keys, vectors,
+        voice=None, audio=None):
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'source': source,
+        'model': model_id,
+        'entries': len(script),
+        'voice': voice,
+        'audio': audio or {},
+    }
+
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    numpy.save(os.path.join(tmp, 'vectors.npy'),
+            numpy.asarray(vectors, dtype=numpy.float32))
+    with open(os.path.join(tmp, 'strings.json'), 'w',
+            encoding='utf-8') as fh:
+        json.dump({'script': list(script.items()), 'keys': list(keys)}, fh,
+                ensure_ascii=False)
+    with open(os.path.join(tmp, 'manifest.json'), 'w',
+            encoding='utf-8') as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=1)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+
+def load_bundle(path, source, model_id):
+    """Returns the Bundle at `path`, or None if missing or stale."""
+    try:
+        with open(os.path.join(path, 'manifest.json'),
+                encoding='utf-8') as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return
+
+    if manifest.get('version') != BUNDLE_VERSION or \
+            manifest.get('source') != source or \
+            manifest.get('model') != model_id:
+        log.info("Bundle %s is stale", path)
+        return
+
+    with open(os.path.join(path, 'strings.json'), encoding='utf-8') as fh:
+        strings = json.load(fh)
+    # Copy-on-write, so the reader can still add and remove lines.
+    vectors = numpy.load(os.path.join(path, 'vectors.npy'), mmap_mode='c')
+
+    script = ScriptStore(strings['script'])
+    return Bundle(path, manifest, script, strings['keys'], vectors)
+
+
+def compile_bundle(reader):
+    """Writes the bundle of the script file of a W2VScriptReader.
+
+    The file is read once for both its digest and its lines, so the
+    bundle matches the file even while it is being edited.  Only taking
+    the phrase vectors needs the reader's lock, the rest runs beside
+    lookups.
+    """
+    import main
+
+    with open(reader.filename, 'rb') as fh:
+        data = fh.read()
+    script = reader.parse_script(
+            data.decode('utf-8').splitlines(True))
+
+    keys = [key for key in script if key != 'default']
+    vectors = reader.phrase_vectors(keys)
+    tts = reader.tts or main.tts_service()
+    audio = {reply: reader.reply_keys(reply)
+             for reply in set(script.values())}
+    write_bundle(bundle_path(reader.filename),
+            hashlib.sha1(data).hexdigest(),
+            model_identity(reader.w2v),
+            script, keys, vectors, [tts.voice, tts.lang], audio)
+    return len(keys)
+
+
+def render_audio(reader):
+    """Synthesizes the replies missing from the audio cache."""
+    import main
+
+    missing = [reply for reply in set(reader.script.values())
+               if not main.is_synthesized(reply)]
+    for reply in missing:
+        main.synthesize_reply(reply)
+    return len(missing)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', help='The script file to compile.')
+    parser.add_argument('--audio', action='store_true',
+            help='Synthesize missing replies with Google TTS.')
+    args = parser.parse_args()
+
+    import main
+    if args.audio:
+        from google.cloud import texttospeech
+        main.TTS_CLIENT = texttospeech.TextToSpeechClient()
+
+    reader = main.W2VScriptReader(args.script, None, lang=main.LANG)
+    entries = compile_bundle(reader)
+    print("Compiled {} entries into {}".format(entries,
+        bundle_path(args.script)))
+    if args.audio:
+        print("Rendered {} replies".format(render_audio(reader)))
+        main.AUDIO_CACHE.flush()
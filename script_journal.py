@@ -0,0 +1,315 @@
+"""Durable script edits and hot reload of the script file.
+
+Lines added and removed by voice go to an append-only journal next to
+the script, one JSON record per line, flushed to disk before the command
+returns.  A background thread folds the journal into the script file:
+only the affected line pairs are rewritten, the rest of the file is kept
+as the author wrote it, and the new file replaces the old one atomically.
+Records are idempotent, so a crash between replacing the script and
+truncating the journal only replays edits the file already has.
+
+Only main() and characters.py journal to disk; readers built without a
+journal, like the replay harness's, keep their edits in a MemoryJournal
+and never touch the script.
+
+ScriptWatcher polls the script file on its own thread and calls
+ScriptReader.sync(), which applies the changed lines instead of reloading
+the whole script, also while nobody speaks and no recognition result
+arrives:
+
+    journal = ScriptJournal('script-ru-RU.txt', ScriptReader._text_process)
+    journal.add('привет', 'здравствуй')
+    journal.compact()
+"""
+
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def replace_file(filename, text):
+    """Atomically replaces the contents of `filename` with `text`."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        fh.write(text)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, filename)
+    _fsync_directory(filename)
+
+
+class MemoryJournal(object):
+    """Keeps edits in memory only, the script file is never written."""
+    def __init__(self):
+        self._records = []
+        # Called after every compaction into the script file.
+        self.compacted = []
+
+    def add(self, key, value):
+        self._records.append(('add', key, value))
+
+    def remove(self, key):
+        self._records.append(('remove', key, None))
+
+    def records(self):
+        """Journaled records, ``(op, key, value)``."""
+        return list(self._records)
+
+    def replay(self, script):
+        """Applies the journaled edits to the `script` mapping."""
+        for op, key, value in self.records():
+            if op == 'add':
+                script[key] = value
+            else:
+                script.pop(key, None)
+        return script
+
+    def compact(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class ScriptJournal(MemoryJournal):
+    def __init__(self, filename, text_process, delay=5.0):
+        """`text_process` is ScriptReader._text_process of the readers.
+
+        Edits are compacted into the script `delay` seconds after the
+        last one.
+        """
+        self.filename = filename
+        self.path = filename + '.journal'
+        self.text_process = text_process
+        self.delay = delay
+        self.compactions = 0
+        self.compacted = []
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._fh = None
+        self._thread = threading.Thread(target=self._run,
+                name='script-journal', daemon=True)
+        self._thread.start()
+        if self.records():
+            # Left over from a crash.
+            self._wake.set()
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, 'a+b')
+                self._fh.seek(0, os.SEEK_END)
+                if self._fh.tell():
+                    # Do not continue a record torn by a crash.
+                    self._fh.seek(-1, os.SEEK_END)
+                    if self._fh.read(1) != b'\n':
+                        line = '\n' + line
+            self._fh.write(line.encode('utf-8'))
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        self._wake.set()
+
+    def add(self, key, value):
+        self._append({'op': 'add', 'key': key, 'value': value})
+
+    def remove(self, key):
+        self._append({'op': 'remove', 'key': key})
+
+    def records(self):
+        return self._read()[0]
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return [], 0
+        records = []
+        size = 0
+        for line in data.splitlines(True):
+            if not line.endswith(b'\n'):
+                # Torn by a crash while appending.
+                break
+            size += len(line)
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                log.warning("Skipping a broken record in %s", self.path)
+                continue
+            records.append((record['op'], record['key'],
+                            record.get('value')))
+        return records, size
+
+    def _apply(self, lines, records):
+        # Line numbers of every key and its reply, parsed like
+        # ScriptReader.read_script does.
+        pairs = {}
+        i = 0
+        while i < len(lines):
+            key = self.text_process(lines[i], is_input=True)
+            if not key:
+                i += 1
+                continue
+            if i + 1 == len(lines):
+                break
+            if self.text_process(lines[i + 1]):
+                pairs.setdefault(key, []).append(i)
+            i += 2
+
+        dropped = set()
+        appended = {}
+        for op, key, value in records:
+            if op == 'add':
+                if key in pairs:
+                    i = pairs[key][-1]
+                    lines[i + 1] = value + '\n'
+                else:
+                    appended[key] = value
+            else:
+                appended.pop(key, None)
+                for i in pairs.pop(key, ()):
+                    dropped.update((i, i + 1))
+
+        lines = [line for i, line in enumerate(lines) if i not in dropped]
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        for key, value in appended.items():
+            if lines and lines[-1].strip():
+                lines.append('\n')
+            lines.extend((key + '\n', value + '\n'))
+        return ''.join(lines)
+
+    def compact(self):
+        """Folds the journal into the script file, returns False if the
+        file changed meanwhile and it should be tried again."""
+        done = self._compact()
+        if done is None:
+            return True
+        if done:
+            # Outside _compact_lock, callbacks may take a reader's lock
+            # that is held while compacting by ScriptReader.save_script.
+            for callback in self.compacted:
+                try:
+                    callback()
+                except Exception:
+                    log.exception("Callback after compacting %s failed",
+                            self.filename)
+        return done
+
+    def _compact(self):
+        """Returns None if there was nothing to compact."""
+        with self._compact_lock:
+            records, size = self._read()
+            if not records:
+                return
+
+            stat = os.stat(self.filename)
+            with open(self.filename, encoding='utf-8') as fh:
+                lines = fh.readlines()
+            text = self._apply(lines, records)
+            if os.stat(self.filename).st_mtime_ns != stat.st_mtime_ns:
+                log.info("%s changed while compacting", self.filename)
+                return False
+            replace_file(self.filename, text)
+
+            # Records appended meanwhile stay in the journal.
+            with self._lock:
+                with open(self.path, 'rb') as fh:
+                    fh.seek(size)
+                    rest = fh.read()
+                rest = rest[:rest.rfind(b'\n') + 1]
+                if self._fh is not None:
+                    self._fh.close()
+                    self._fh = None
+                if rest:
+                    replace_file(self.path, rest.decode('utf-8'))
+                else:
+                    os.unlink(self.path)
+                    _fsync_directory(self.path)
+            self.compactions += 1
+            log.info("Compacted %d edits into %s", len(records),
+                    self.filename)
+            return True
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # Edits usually come in bursts, compact after the last one.
+            while self._wake.is_set() and not self._closed.is_set():
+                self._wake.clear()
+                self._closed.wait(self.delay)
+            if self._closed.is_set():
+                return
+            try:
+                if not self.compact():
+                    self._wake.set()
+            except OSError as e:
+                log.warning("Can't compact %s: %s", self.path, e)
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self._thread.join()
+        try:
+            self.compact()
+        except OSError as e:
+            log.warning("Can't compact %s: %s", self.path, e)
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+class ScriptWatcher(object):
+    """Calls `on_change()` whenever the script file is modified or
+    replaced."""
+    def __init__(self, filename, on_change, interval=1.0):
+        self.filename = filename
+        self.on_change = on_change
+        self.interval = interval
+        self._stat = self._state()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                name='script-watch', daemon=True)
+        self._thread.start()
+
+    def _state(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            state = self._state()
+            if state is not None and state != self._stat:
+                self._stat = state
+                try:
+                    self.on_change()
+                except Exception:
+                    log.exception("Can't apply the changes of %s",
+                            self.filename)
+
+    def stop(self):
+        self._stopped.set()
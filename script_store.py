@@ -0,0 +1,388 @@
+"""Columnar storage of script entries.
+
+A ScriptStore is an ordered mapping of normalized line -> reply like the
+OrderedDict it replaces, but without a Python object per string or per
+entry.  Every distinct string is stored once, UTF-8 encoded in one
+buffer, and addressed by an integer id through offset arrays; a reply
+shared by many lines is stored once.  Entries are ids in typed arrays.
+
+The id of an entry is the id of its key string.  Ids are never reused
+while the store lives, so indexes keyed by entry id, like the
+W2VScriptReader vector index, stay valid across edits and reloads.
+
+On a synthetic 100k-line script an entry takes ~117 bytes against ~329
+in an OrderedDict; ~63 of them are the UTF-8 text itself, which bounds
+what any layout can save.  Lookups probe the table in Python, so `get`
+costs ~1.2us on a hit and ~0.3us on a miss against ~0.1us for a dict.
+
+Example usage:
+    python script_store.py script-ru-RU.txt
+"""
+
+import argparse
+import array
+import collections
+import collections.abc
+import tracemalloc
+
+
+EMPTY = -1
+DELETED = -2
+
+
+class StringTable(object):
+    """Interned UTF-8 strings with reference counts.
+
+    Strings are found through an open addressing table of ids, probed
+    linearly by the low 32 bits of the string hash, which are kept per id
+    so that most probes and every resize skip the string itself.
+    """
+    def __init__(self):
+        self._data = bytearray()
+        # Start of every string in _data, and the end of the last one.
+        self._starts = array.array('q', [0])
+        self._refs = array.array('I')
+        self._hashes = array.array('I')
+        self._table = array.array('i', [EMPTY]) * 8
+        # Slots that are not EMPTY.
+        self._filled = 0
+        self._garbage = 0
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __getitem__(self, i):
+        return self._data[self._starts[i]:self._starts[i + 1]].decode('utf-8')
+
+    def _slot(self, s, h):
+        """The slot of `s` with hash `h`, or -1 - the first free slot."""
+        table = self._table
+        hashes = self._hashes
+        starts = self._starts
+        mask = len(table) - 1
+        slot = h & mask
+        free = -1
+        data = None
+        while True:
+            i = table[slot]
+            if i == EMPTY:
+                return -1 - (slot if free < 0 else free)
+            if i == DELETED:
+                if free < 0:
+                    free = slot
+            elif hashes[i] == h:
+                if data is None:
+                    data = s.encode('utf-8')
+                if self._data[starts[i]:starts[i + 1]] == data:
+                    return slot
+            slot = (slot + 1) & mask
+
+    def find(self, s):
+        """Returns the id of `s`, or -1."""
+        # _slot() inlined, this is the lookup of every transcript.
+        h = hash(s) & 0xffffffff
+        table = self._table
+        mask = len(table) - 1
+        slot = h & mask
+        while True:
+            i = table[slot]
+            if i >= 0:
+                if self._hashes[i] == h:
+                    starts = self._starts
+                    if self._data[starts[i]:starts[i + 1]] == \
+                            s.encode('utf-8'):
+                        return i
+            elif i == EMPTY:
+                return -1
+            slot = (slot + 1) & mask
+
+    def add(self, s):
+        """Returns the id of `s`, adding a reference."""
+        h = hash(s) & 0xffffffff
+        slot = self._slot(s, h)
+        if slot >= 0:
+            i = self._table[slot]
+            self._refs[i] += 1
+            return i
+        slot = -1 - slot
+        i = len(self._refs)
+        self._data += s.encode('utf-8')
+        self._starts.append(len(self._data))
+        self._refs.append(1)
+        self._hashes.append(h)
+        if self._table[slot] == EMPTY:
+            self._filled += 1
+        self._table[slot] = i
+        if self._filled * 2 > len(self._table):
+            self._resize()
+        return i
+
+    def release(self, i):
+        self._refs[i] -= 1
+        if self._refs[i]:
+            return
+        table = self._table
+        mask = len(table) - 1
+        slot = self._hashes[i] & mask
+        while table[slot] != i:
+            slot = (slot + 1) & mask
+        table[slot] = DELETED
+        self._garbage += self._starts[i + 1] - self._starts[i]
+        if self._garbage > len(self._data) // 2:
+            self.compact()
+
+    def alive(self, i):
+        return 0 <= i < len(self._refs) and self._refs[i] > 0
+
+    def _resize(self):
+        alive = sum(1 for r in self._refs if r)
+        size = 8
+        while size < alive * 4:
+            size *= 2
+        table = array.array('i', [EMPTY]) * size
+        mask = size - 1
+        for i, (refs, h) in enumerate(zip(self._refs, self._hashes)):
+            if not refs:
+                continue
+            slot = h & mask
+            while table[slot] != EMPTY:
+                slot = (slot + 1) & mask
+            table[slot] = i
+        self._table = table
+        self._filled = sum(1 for i in table if i != EMPTY)
+
+    def compact(self):
+        """Drops released strings from the buffer, ids do not change."""
+        data = bytearray()
+        starts = self._starts
+        for i, refs in enumerate(self._refs):
+            start, end = starts[i], starts[i + 1]
+            starts[i] = len(data)
+            if refs:
+                data += self._data[start:end]
+        starts[len(self._refs)] = len(data)
+        self._data = data
+        self._garbage = 0
+
+    def nbytes(self):
+        return sum(len(a) * a.itemsize for a in (self._starts, self._refs,
+                self._hashes, self._table)) + len(self._data)
+
+
+class Entry(object):
+    """View of one script entry."""
+    __slots__ = ('_store', 'id')
+
+    def __init__(self, store, i):
+        self._store = store
+        self.id = i
+
+    @property
+    def key(self):
+        return self._store.strings[self.id]
+
+    @property
+    def reply(self):
+        return self._store.reply(self.id)
+
+    def __repr__(self):
+        return 'Entry({}, {!r}, {!r})'.format(self.id, self.key, self.reply)
+
+
+class _Items(collections.abc.ItemsView):
+    def __iter__(self):
+        strings = self._mapping.strings
+        replies = self._mapping._replies
+        for i in self._mapping.ids():
+            yield strings[i], strings[replies[i]]
+
+
+class _Values(collections.abc.ValuesView):
+    def __iter__(self):
+        strings = self._mapping.strings
+        replies = self._mapping._replies
+        for i in self._mapping.ids():
+            yield strings[replies[i]]
+
+
+class ScriptStore(collections.abc.MutableMapping):
+    def __init__(self, items=()):
+        self.strings = StringTable()
+        # Entry order, ids of removed entries are -1 until compacted.
+        self._order = array.array('i')
+        self._removed = 0
+        # By key string id: the reply string id and the position in
+        # _order, -1 if the string is no key.
+        self._replies = array.array('i')
+        self._positions = array.array('i')
+        self._len = 0
+        for key, reply in items:
+            self[key] = reply
+
+    def __len__(self):
+        return self._len
+
+    def id(self, key):
+        """The entry id of `key`, or -1."""
+        i = self.strings.find(key)
+        if i >= 0 and i < len(self._replies) and self._replies[i] >= 0:
+            return i
+        return -1
+
+    def has_id(self, i):
+        return (self.strings.alive(i) and i < len(self._replies)
+                and self._replies[i] >= 0)
+
+    def key(self, i):
+        return self.strings[i]
+
+    def reply(self, i):
+        return self.strings[self._replies[i]]
+
+    def entry(self, key):
+        i = self.id(key)
+        if i < 0:
+            raise KeyError(key)
+        return Entry(self, i)
+
+    def ids(self):
+        for i in self._order:
+            if i >= 0:
+                yield i
+
+    def entries(self):
+        for i in self.ids():
+            yield Entry(self, i)
+
+    def __contains__(self, key):
+        return self.id(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.id(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.strings[self._replies[i]]
+
+    def get(self, key, default=None):
+        i = self.strings.find(key)
+        if i < 0 or i >= len(self._replies) or self._replies[i] < 0:
+            return default
+        return self.strings[self._replies[i]]
+
+    def __setitem__(self, key, reply):
+        self._set(key, reply)
+
+    def _set(self, key, reply):
+        """Sets `key` to `reply`, returns the entry id."""
+        i = self.id(key)
+        if i >= 0 and self._replies[i] == self.strings.find(reply):
+            return i
+        reply_id = self.strings.add(reply)
+        if i >= 0:
+            self.strings.release(self._replies[i])
+            self._replies[i] = reply_id
+            return i
+        i = self.strings.add(key)
+        if len(self._replies) <= i:
+            grow = array.array('i', [-1]) * (i + 1 - len(self._replies))
+            self._replies.extend(grow)
+            self._positions.extend(grow)
+        self._replies[i] = reply_id
+        self._positions[i] = len(self._order)
+        self._order.append(i)
+        self._len += 1
+        return i
+
+    def __delitem__(self, key):
+        i = self.id(key)
+        if i < 0:
+            raise KeyError(key)
+        self.strings.release(self._replies[i])
+        self._replies[i] = -1
+        self.strings.release(i)
+        self._order[self._positions[i]] = -1
+        self._positions[i] = -1
+        self._removed += 1
+        self._len -= 1
+        if self._removed > len(self._order) // 2:
+            self._reorder(list(self.ids()))
+
+    def _reorder(self, ids):
+        self._order = array.array('i', ids)
+        for position, i in enumerate(ids):
+            self._positions[i] = position
+        self._removed = 0
+
+    def __iter__(self):
+        strings = self.strings
+        for i in self.ids():
+            yield strings[i]
+
+    def items(self):
+        return _Items(self)
+
+    def values(self):
+        return _Values(self)
+
+    def reset(self, items):
+        """Replaces the contents, keeping the ids of lines still present."""
+        items = collections.OrderedDict(items)
+        for key in [key for key in self if key not in items]:
+            del self[key]
+        self._reorder([self._set(key, reply)
+                       for key, reply in items.items()])
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self.items()))
+
+    def nbytes(self):
+        return self.strings.nbytes() + sum(len(a) * a.itemsize
+                for a in (self._order, self._replies, self._positions))
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    obj = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    return obj, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', nargs='?',
+            help='Script to measure, or a synthetic one of --entries.')
+    parser.add_argument('--entries', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.script:
+        import main as bot
+        items = list(bot.ScriptReader.read_script(args.script).items())
+    else:
+        items = [('строка номер {} про что-нибудь ещё'.format(i),
+                  'ответ {}'.format(i % 100)) for i in range(args.entries)]
+    # Strings as read from a file, not shared with `items`.
+    lines = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in items]
+    del items
+
+    def ordered_dict():
+        return collections.OrderedDict((k.decode('utf-8'), v.decode('utf-8'))
+                for k, v in lines)
+
+    def store():
+        return ScriptStore((k.decode('utf-8'), v.decode('utf-8'))
+                for k, v in lines)
+
+    od, od_size = measure(ordered_dict)
+    st, st_size = measure(store)
+    print("{} entries: OrderedDict {:.1f} bytes/entry, ScriptStore "
+          "{:.1f} bytes/entry".format(len(lines), od_size / len(lines),
+              st_size / len(lines)))
+
+
+if __name__ == '__main__':
+    main()
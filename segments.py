@@ -0,0 +1,111 @@
+"""Splitting replies into separately synthesized segments.
+
+Long replies are cut at sentence ends and, in SSML replies, at top-level
+`<break>` tags, so the first segment can play while the rest are still
+being synthesized.  Each segment is cached under its own key, so a
+sentence shared by several replies is synthesized once.  A `<break>`
+becomes the pause after its segment; breaks and sentence ends nested in
+other elements are left alone.
+"""
+
+import collections
+import re
+
+Segment = collections.namedtuple('Segment', 'text ssml pause')
+
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+TAG = re.compile(r'<(/?)([\w:-]+)([^>]*?)(/?)>')
+BREAK_TIME = re.compile(r'time\s*=\s*["\']([\d.]+)\s*(ms|s)["\']')
+BREAK_STRENGTH = re.compile(r'strength\s*=\s*["\']([\w-]+)["\']')
+
+# Seconds, per the SSML defaults for break strengths.
+STRENGTHS = {
+    'none': 0., 'x-weak': .1, 'weak': .25, 'medium': .5, 'strong': .75,
+    'x-strong': 1.25,
+}
+
+# Sentences shorter than this are merged into the next one.
+MIN_LENGTH = 20
+
+
+def break_pause(attributes):
+    match = BREAK_TIME.search(attributes)
+    if match:
+        value, unit = match.groups()
+        return float(value) / (1000. if unit == 'ms' else 1.)
+    match = BREAK_STRENGTH.search(attributes)
+    return STRENGTHS.get(match.group(1) if match else 'medium', .5)
+
+
+def _pieces(txt):
+    """Yields ``(text, pause)`` cut at top-level sentence ends and breaks."""
+    depth = 0
+    current = ''
+    pos = 0
+    for tag in TAG.finditer(txt):
+        text = txt[pos:tag.start()]
+        pos = tag.end()
+        if depth == 0:
+            sentences = SENTENCE_END.split(text)
+            for sentence in sentences[:-1]:
+                yield current + sentence, 0.
+                current = ''
+            current += sentences[-1]
+        else:
+            current += text
+
+        closing, name, attributes, empty = tag.groups()
+        if name == 'break' and depth == 0 and current.strip():
+            yield current, break_pause(attributes)
+            current = ''
+            continue
+        current += tag.group(0)
+        if closing:
+            depth = max(depth - 1, 0)
+        elif not empty:
+            depth += 1
+
+    text = txt[pos:]
+    if depth == 0:
+        sentences = SENTENCE_END.split(text)
+        for sentence in sentences[:-1]:
+            yield current + sentence, 0.
+            current = ''
+        current += sentences[-1]
+    else:
+        current += text
+    yield current, 0.
+
+
+def split_reply(txt, min_length=MIN_LENGTH):
+    """Returns the segments of a reply, SSML if it starts with '<'."""
+    ssml = txt[:1] == '<'
+    if not ssml:
+        pieces = ((sentence, 0.) for sentence in SENTENCE_END.split(txt))
+    else:
+        pieces = _pieces(txt)
+
+    segments = []
+    pending, pending_pause = '', 0.
+    for text, pause in pieces:
+        text = text.strip()
+        if pending:
+            text = (pending + ' ' + text).strip()
+            pause += pending_pause
+        if not text:
+            pending, pending_pause = '', pause
+            if segments:
+                segments[-1] = segments[-1]._replace(
+                        pause=segments[-1].pause + pause)
+            continue
+        if len(text) < min_length and not pause:
+            pending, pending_pause = text, pause
+            continue
+        pending, pending_pause = '', 0.
+        segments.append(Segment(text, ssml, pause))
+    if pending and segments and not segments[-1].pause:
+        last = segments.pop()
+        pending = last.text + ' ' + pending
+    if pending:
+        segments.append(Segment(pending, ssml, pending_pause))
+    return segments or [Segment(txt, ssml, 0.)]
@@ -0,0 +1,220 @@
+"""Speculative reply preparation on interim transcripts.
+
+SpeculativeReader wraps a W2VScriptReader.  Interim transcripts that do
+not match exactly are debounced; once the transcript has been stable for
+`delay` seconds the semantic lookup runs in the background and the likely
+reply is prepared (synthesized and decoded) ahead of time.  When the final
+transcript arrives it either commits to that work, if it normalizes to the
+same text, or cancels it and resolves the final as usual.
+
+A hit is played as soon as its reply is looked up: the segments still
+being synthesized are coalesced by the TTSService, so playback picks up
+the speculative work where it is.  The time saved is how much earlier the
+first segment is ready than it would be if synthesis only started at the
+final transcript.  A speculation whose lookup failed is treated like a
+miss.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Speculation(object):
+    def __init__(self, key, transcript):
+        self.key = key
+        self.transcript = transcript
+        self.started = time.time()
+        # When the first segment of the reply could start playing.
+        self.ready = None
+        self.replica = None
+        self.resolved = threading.Event()
+        self.future = None
+        self.failed = False
+        self.cancelled = threading.Event()
+
+    def set_ready(self):
+        self.ready = time.time()
+
+    def cancel(self):
+        """Stops the work at the next step, a queued one never starts."""
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+
+class SpeculativeReader(object):
+    def __init__(self, reader, prepare=None, delay=0.25):
+        self.reader = reader
+        self.prepare = prepare
+        self.delay = delay
+
+        self.speculations = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.saved = 0.
+
+        self._lock = threading.Lock()
+        self._timer = None
+        self._current = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='speculative')
+
+    def __getattr__(self, name):
+        # Everything else (script, update, add, ...) is the reader's.
+        return getattr(self.reader, name)
+
+    def stats(self):
+        decided = self.hits + self.misses
+        return {
+            'speculations': self.speculations,
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures,
+            'hit_rate': self.hits / float(decided) if decided else 0.,
+            'saved_seconds': self.saved,
+        }
+
+    def _key(self, transcript):
+        return self.reader._text_process(transcript, is_input=True)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self, transcript):
+        with self._lock:
+            self._cancel_timer()
+            current = self._current
+            if current is not None and current.key == self._key(transcript):
+                return
+            self._timer = threading.Timer(self.delay, self._start,
+                    (transcript,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _drop_current(self):
+        if self._current is not None:
+            self._current.cancel()
+            self._current = None
+
+    def _start(self, transcript):
+        speculation = Speculation(self._key(transcript), transcript)
+        with self._lock:
+            self._timer = None
+            # A newer interim supersedes it.
+            self._drop_current()
+            self._current = speculation
+            self.speculations += 1
+            speculation.future = self._executor.submit(self._work,
+                    speculation)
+
+    def _work(self, speculation):
+        if speculation.cancelled.is_set():
+            return
+        try:
+            replica = self.reader.resolve(speculation.transcript, True)
+        except Exception as e:
+            log.warning("Speculation on %r failed: %s",
+                    speculation.transcript, e)
+            speculation.failed = True
+            return
+        speculation.replica = replica
+        speculation.resolved.set()
+
+        if replica and self.prepare is not None and \
+                not speculation.cancelled.is_set():
+            try:
+                self.prepare(replica, stop=speculation.cancelled,
+                        ready=speculation.set_ready)
+            except Exception as e:
+                # A hit already plays it and runs into the error itself.
+                log.warning("Preparing %r failed: %s", replica, e)
+        return replica
+
+    def _take(self, transcript):
+        """Returns the speculation matching the final `transcript`."""
+        with self._lock:
+            self._cancel_timer()
+            speculation, self._current = self._current, None
+        if speculation is None or speculation.future is None:
+            return
+        if speculation.key == self._key(transcript):
+            return speculation
+        speculation.cancel()
+        self.misses += 1
+
+    def _interim(self, replied, transcript):
+        """Speculates on `transcript` unless the reader already replied."""
+        if replied:
+            with self._lock:
+                self._cancel_timer()
+                self._drop_current()
+            return True
+        self._schedule(transcript)
+
+    def __call__(self, transcript, is_final=False):
+        if not is_final:
+            return self._interim(self.reader(transcript, is_final),
+                    transcript)
+
+        speculation = self._take(transcript)
+        if speculation is None:
+            return self.reader(transcript, is_final)
+        return self._commit(speculation, transcript,
+                lambda: self.reader(transcript, is_final))
+
+    def respond(self, alternatives, is_final=False):
+        """Like `__call__` over ``(transcript, confidence)`` pairs.
+
+        Speculation follows the top alternative; when the final one
+        differs all alternatives are resolved together as usual.
+        """
+        if not is_final:
+            if not alternatives:
+                return
+            return self._interim(self.reader.respond(alternatives, is_final),
+                    alternatives[0][0])
+
+        speculation = self._take(alternatives[0][0])
+        if speculation is None:
+            return self.reader.respond(alternatives, is_final)
+        return self._commit(speculation, alternatives[0][0],
+                lambda: self.reader.respond(alternatives, is_final))
+
+    def _commit(self, speculation, transcript, fallback):
+        """Replies with the speculation, or with `fallback()` if it failed.
+
+        Only the lookup is waited for, not the preparation.
+        """
+        arrived = time.time()
+        while not speculation.resolved.wait(0.05):
+            if speculation.future.done():
+                break
+        if not speculation.resolved.is_set():
+            self.failures += 1
+            return fallback()
+        replica = speculation.replica
+        self.hits += 1
+        ready = speculation.ready
+        self.saved += min(ready or arrived, arrived) - speculation.started
+        log.debug("Speculation hit, %s", self.stats())
+        if not replica:
+            return
+
+        log.info("Got %s, respond with %s", transcript, replica)
+
+        self.reader.callback(replica)
+
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            self._cancel_timer()
+            self._drop_current()
+        self._executor.shutdown(wait=False, cancel_futures=True)
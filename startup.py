@@ -0,0 +1,164 @@
+"""Fast startup: profiling and the background-loaded reader.
+
+The bot starts listening with the exact-match ScriptReader while the
+word2vec reader, with its model, morphology and script vectors, loads on
+a background thread; LazyReader switches to it once it is ready.
+
+With --profile-startup main.py times every top-level import and the
+startup phases and logs a report once the semantic reader is up:
+
+    python main.py --profile-startup
+"""
+
+import builtins
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+STARTED = time.perf_counter()
+
+
+class ImportTimer(object):
+    """Cumulative time of the first import of every module."""
+    def __init__(self):
+        self.times = {}
+        self._import = None
+
+    def install(self):
+        if self._import is None:
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed
+
+    def uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        t1 = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self.times.setdefault(name, time.perf_counter() - t1)
+
+    def report(self, top=15):
+        ranked = sorted(self.times.items(), key=lambda x: -x[1])[:top]
+        return ["{:>9.1f}ms  import {}".format(seconds * 1000, name)
+                for name, seconds in ranked]
+
+
+class Profile(object):
+    """Startup phases, as offsets from process start."""
+    def __init__(self):
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end=None):
+        if end is None:
+            end = start
+        with self._lock:
+            self.phases.append((start - STARTED, end - start, name,
+                threading.current_thread().name))
+
+    def mark(self, name):
+        self.add(name, time.perf_counter())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, t1, time.perf_counter())
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases)
+        lines = ["{:>9.1f}ms {:>9.1f}ms  {} [{}]".format(start * 1000,
+                    seconds * 1000, name, thread)
+                 for start, seconds, name, thread in phases]
+        if IMPORTS.times:
+            lines.append("Slowest imports:")
+            lines.extend(IMPORTS.report())
+        return '\n'.join(lines)
+
+
+IMPORTS = ImportTimer()
+PROFILE = Profile()
+
+
+class LazyReader(object):
+    """Answers with `reader` until `load()` has built the full one.
+
+    Script edits made meanwhile are picked up by the new reader with
+    sync() before the switch, they are in the script file or its
+    journal by then.
+    """
+    def __init__(self, reader, load, on_ready=None):
+        self.reader = reader
+        self.ready = threading.Event()
+        self._edits = []
+        self._lock = threading.RLock()
+        self._thread = threading.Thread(target=self._load,
+                args=(load, on_ready), name='reader-load', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def __call__(self, transcript, is_final=False):
+        return self.reader(transcript, is_final)
+
+    def respond(self, alternatives, is_final=False):
+        return self.reader.respond(alternatives, is_final)
+
+    def _edit(self, name, *args):
+        with self._lock:
+            if not self.ready.is_set():
+                self._edits.append(name)
+            return getattr(self.reader, name)(*args)
+
+    def add(self, key, value):
+        return self._edit('add', key, value)
+
+    def remove(self, key):
+        return self._edit('remove', key)
+
+    def update(self):
+        return self._edit('update')
+
+    def sync(self):
+        return self._edit('sync')
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def _load(self, load, on_ready):
+        try:
+            with PROFILE.phase('semantic reader'):
+                reader = load()
+        except Exception:
+            log.exception("Can't load the semantic reader, "
+                          "staying with exact matching")
+            return
+
+        with self._lock:
+            if self._edits:
+                try:
+                    reader.sync()
+                except OSError as e:
+                    log.warning("Can't sync the script: %s", e)
+            self._edits = []
+            self.reader = reader
+            self.ready.set()
+        PROFILE.mark('semantic matching on')
+        log.info("Semantic matching is on")
+
+        if on_ready is not None:
+            on_ready(reader)
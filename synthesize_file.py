@@ -22,62 +22,61 @@ Example usage:
 """
 
 import argparse
-import time
-
+import functools
 
 from google.cloud import texttospeech
 
+import metrics
+
 LANG='en-US'
 
 VOICE_NAME='ru-RU-WaveNet-A'
 
-# [START tts_synthesize_text_file]
-def synthesize_text_file(text, client, out, lang=LANG):
-    """Synthesizes speech from the input file of text."""
-    input_text = texttospeech.types.SynthesisInput(text=text)
-
+@functools.lru_cache(maxsize=None)
+def request_templates(lang=LANG, voice_name=VOICE_NAME):
+    """Returns the ``(voice, audio_config)`` every request reuses."""
     # Note: the voice can also be specified by name.
     # Names of voices can be retrieved with client.list_voices().
     voice = texttospeech.types.VoiceSelectionParams(
         language_code=lang,
-        name=VOICE_NAME)
+        name=voice_name)
 
     audio_config = texttospeech.types.AudioConfig(
         audio_encoding=texttospeech.enums.AudioEncoding.MP3)
+    return voice, audio_config
+
 
-    t1 = time.time()
-    response = client.synthesize_speech(input_text, voice, audio_config)
+# [START tts_synthesize_text_file]
+def synthesize_text_file(text, client, out, lang=LANG,
+        voice_name=VOICE_NAME):
+    """Synthesizes speech from the input file of text."""
+    input_text = texttospeech.types.SynthesisInput(text=text)
+    voice, audio_config = request_templates(lang, voice_name)
+
+    with metrics.span('tts'):
+        response = client.synthesize_speech(input_text, voice, audio_config)
 
     # The response's audio_content is binary.
     out.write(response.audio_content)
-    print(time.time() - t1)
 # [END tts_synthesize_text_file]
 
 
 # [START tts_synthesize_ssml_file]
-def synthesize_ssml_file(ssml, client, out, lang=LANG):
+def synthesize_ssml_file(ssml, client, out, lang=LANG,
+        voice_name=VOICE_NAME):
     """Synthesizes speech from the input file of ssml.
 
     Note: ssml must be well-formed according to:
         https://www.w3.org/TR/speech-synthesis/
     """
     input_text = texttospeech.types.SynthesisInput(ssml=ssml)
+    voice, audio_config = request_templates(lang, voice_name)
 
-    # Note: the voice can also be specified by name.
-    # Names of voices can be retrieved with client.list_voices().
-    voice = texttospeech.types.VoiceSelectionParams(
-        language_code=lang,
-        name=VOICE_NAME)
-
-    audio_config = texttospeech.types.AudioConfig(
-        audio_encoding=texttospeech.enums.AudioEncoding.MP3)
-
-    t1 = time.time()
-    response = client.synthesize_speech(input_text, voice, audio_config)
+    with metrics.span('tts'):
+        response = client.synthesize_speech(input_text, voice, audio_config)
 
     # The response's audio_content is binary.
     out.write(response.audio_content)
-    print(time.time() - t1)
 # [END tts_synthesize_ssml_file]
 
 
@@ -28,31 +28,57 @@ Example usage:
 # [START speech_transcribe_streaming_mic]
 from __future__ import division
 
+import collections
 import re
 import sys
+import threading
+import time
 
 import numpy
 
+from google.api_core import exceptions
 from google.cloud import speech
 from google.cloud.speech import enums
 from google.cloud.speech import types
 import pyaudio
-from six.moves import queue
+
+import metrics
 
 # Audio recording parameters
 RATE = 44100
 CHUNK = int(RATE / 10)  # 100ms
+BUFFER_SECONDS = 30
+NOISE_SECONDS = 1
 
 
 class MicrophoneStream(object):
     """Opens a recording stream as a generator yielding the audio chunks."""
-    def __init__(self, rate, chunk, add_noise=0):
+    def __init__(self, rate, chunk, add_noise=0,
+            buffer_seconds=BUFFER_SECONDS, device=None):
         self._rate = rate
         self._chunk = chunk
         self._add_noise = add_noise
+        self._device = device
+
+        # Preallocated single-producer/single-consumer ring of samples.
+        # Positions count samples since the start and only grow: the
+        # callback only advances _write, the reader only advances _read.
+        self._ring = numpy.zeros(int(rate * buffer_seconds),
+                dtype=numpy.int16)
+        self._write = 0
+        self._read = 0
+        self._ready = threading.Event()
+        self.overruns = 0
+
+        # Noise is generated once and replayed, mixed through a reusable
+        # int32 buffer so loud samples saturate instead of wrapping.
+        self._noise = None
+        self._noise_pos = 0
+        self._scratch = numpy.zeros(chunk * 2, dtype=numpy.int32)
+        if add_noise:
+            self._noise = (add_noise * numpy.random.randn(
+                rate * NOISE_SECONDS)).astype(numpy.int32)
 
-        # Create a thread-safe buffer of audio data
-        self._buff = queue.Queue()
         self.closed = True
 
     def __enter__(self):
@@ -63,6 +89,7 @@ class MicrophoneStream(object):
             # https://goo.gl/z757pE
             channels=1, rate=self._rate,
             input=True, frames_per_buffer=self._chunk,
+            input_device_index=self._device,
             # Run the audio stream asynchronously to fill the buffer object.
             # This is necessary so that the input device's buffer doesn't
             # overflow while the calling thread makes network requests, etc.
@@ -77,42 +104,72 @@ class MicrophoneStream(object):
         self._audio_stream.stop_stream()
         self._audio_stream.close()
         self.closed = True
-        # Signal the generator to terminate so that the client's
-        # streaming_recognize method will not block the process termination.
-        self._buff.put(None)
+        # Wake up the reader so that the client's streaming_recognize
+        # method will not block the process termination.
+        self._ready.set()
         self._audio_interface.terminate()
 
+    def _mix_noise(self, samples):
+        n = len(samples)
+        if n > len(self._scratch):
+            self._scratch = numpy.zeros(n, dtype=numpy.int32)
+        out = self._scratch[:n]
+        pos = self._noise_pos
+        if pos + n > len(self._noise):
+            pos = 0
+        numpy.add(samples, self._noise[pos:pos + n], out=out)
+        numpy.clip(out, -32768, 32767, out=out)
+        self._noise_pos = pos + n
+        return out
+
     def _fill_buffer(self, in_data, frame_count, time_info, status_flags):
         """Continuously collect data from the audio stream, into the buffer."""
-        if self._add_noise:
-            buf = numpy.copy(numpy.frombuffer(in_data, dtype=numpy.uint16))
-            noise = self._add_noise * numpy.random.randn(*buf.shape)
-            buf += noise.astype(numpy.uint16)
-            in_data = buf.tobytes()
-        self._buff.put(in_data)
+        samples = numpy.frombuffer(in_data, dtype=numpy.int16)
+        if self._noise is not None:
+            samples = self._mix_noise(samples)
+
+        size = len(self._ring)
+        n = len(samples)
+        pos = self._write % size
+        first = min(n, size - pos)
+        self._ring[pos:pos + first] = samples[:first]
+        self._ring[:n - first] = samples[first:]
+        self._write += n
+        self._ready.set()
         return None, pyaudio.paContinue
 
-    def generator(self):
-        while not self.closed:
-            # Use a blocking get() to ensure there's at least one chunk of
-            # data, and stop iteration if the chunk is None, indicating the
-            # end of the audio stream.
-            chunk = self._buff.get()
-            if chunk is None:
-                return
-            data = [chunk]
+    def read(self, timeout=None):
+        """Returns buffered audio, b'' on timeout, None once closed.
 
-            # Now consume whatever other data's still buffered.
-            while True:
-                try:
-                    chunk = self._buff.get(block=False)
-                    if chunk is None:
-                        return
-                    data.append(chunk)
-                except queue.Empty:
-                    break
+        The audio is a memoryview into the ring buffer, it is only valid
+        until the callback wraps around to it again (BUFFER_SECONDS).
+        """
+        while self._read == self._write:
+            if self.closed:
+                return
+            self._ready.clear()
+            if self._read != self._write:
+                break
+            if not self._ready.wait(timeout):
+                return b''
+
+        size = len(self._ring)
+        write = self._write
+        if write - self._read > size:
+            # The reader fell behind by a whole buffer, skip the oldest.
+            self.overruns += 1
+            self._read = write - size
+        start = self._read % size
+        end = min(start + write - self._read, size)
+        self._read += end - start
+        return memoryview(self._ring[start:end]).cast('B')
 
-            yield b''.join(data)
+    def generator(self):
+        while True:
+            data = self.read()
+            if data is None:
+                return
+            yield data
 
 
 def listen_print_loop(responses):
@@ -183,7 +240,8 @@ def recognize_microphone_stream(listen_loop, lang=LANG, add_noise=0):
 
     with MicrophoneStream(RATE, CHUNK, add_noise) as stream:
         audio_generator = stream.generator()
-        requests = (types.StreamingRecognizeRequest(audio_content=content)
+        requests = (types.StreamingRecognizeRequest(
+                        audio_content=bytes(content))
                     for content in audio_generator)
 
         responses = client.streaming_recognize(streaming_config, requests)
@@ -191,6 +249,198 @@ def recognize_microphone_stream(listen_loop, lang=LANG, add_noise=0):
         # Now, put the transcription responses to use.
         listen_loop(responses)
 
+# The service cuts streaming requests at about 305 seconds.
+STREAMING_LIMIT = 290
+
+
+class RecognitionSession(object):
+    """Long-lived recognition: one client and one open microphone.
+
+    Each `recognize` call is one streaming request on the shared client.
+    Requests roll over before the service's duration limit, and audio is
+    carried across requests: audio recorded while no request was active is
+    sent first, and audio the service never finalized because the request
+    ended is sent again.
+
+    With an audio_pipeline.AudioPipeline the audio is resampled and
+    encoded before upload, and a gating VAD only opens a request once
+    speech starts and half-closes it when speech ends.
+
+    The microphone is streamed while our own replies play too, so that
+    commands like "хватит" are heard; main.Listener ignores the rest.
+    """
+    def __init__(self, lang=LANG, add_noise=0, rate=RATE, chunk=CHUNK,
+            streaming_limit=STREAMING_LIMIT, client=None, pipeline=None,
+            device=None, max_alternatives=1):
+        self._rate = rate
+        self._chunk = chunk
+        self._add_noise = add_noise
+        self._device = device
+        self.max_alternatives = max_alternatives
+        self.streaming_limit = streaming_limit
+        self.client = client
+        self.lang = lang
+        self.pipeline = pipeline
+        self.requests = 0
+        self.rollovers = 0
+        self.bytes_sent = 0
+        self.latencies = []
+
+        self._ended = False
+        self._exhausted = False
+        self._lock = threading.Lock()
+        self._leftover = collections.deque()
+        self._unfinalized = collections.deque(maxlen=100)
+        self._stream = None
+
+    def __enter__(self):
+        if self.client is None:
+            self.client = speech.SpeechClient()
+        encoding, rate = 'LINEAR16', self._rate
+        if self.pipeline is not None:
+            encoding, rate = self.pipeline.encoding, self.pipeline.rate
+        config = types.RecognitionConfig(
+            encoding=getattr(enums.RecognitionConfig.AudioEncoding, encoding),
+            sample_rate_hertz=rate,
+            language_code=self.lang,
+            max_alternatives=self.max_alternatives)
+        self.streaming_config = types.StreamingRecognitionConfig(
+            config=config,
+            interim_results=True)
+        self._stream = MicrophoneStream(self._rate, self._chunk,
+                self._add_noise, device=self._device).__enter__()
+        self._started = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stream.__exit__(type, value, traceback)
+
+    def stats(self):
+        minutes = (time.time() - self._started) / 60
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+        return {
+            'requests': self.requests,
+            'rollovers': self.rollovers,
+            'bytes_per_minute': self.bytes_sent / minutes if minutes else 0,
+            'end_of_speech_to_final_p50': percentile(0.5),
+            'end_of_speech_to_final_p90': percentile(0.9),
+        }
+
+    def _read(self, timeout):
+        """Returns PCM to send, b'' if there is none, None once closed."""
+        data = self._stream.read(timeout=timeout)
+        if not data:
+            return data
+        if self.pipeline is None:
+            return bytes(data)
+        pcm, ended = self.pipeline.process(data)
+        if ended:
+            self._ended = True
+        return pcm
+
+    def _wait_for_speech(self):
+        while True:
+            with self._lock:
+                if self._leftover:
+                    return True
+                pcm = self._read(timeout=0.1)
+                if pcm is None:
+                    return False
+                if pcm:
+                    self._leftover.append(pcm)
+                    return True
+
+    def _requests(self, done):
+        encoder = None
+        if self.pipeline is not None:
+            encoder = self.pipeline.encoder()
+        for data in self._audio(done):
+            if encoder is not None:
+                data = encoder.encode(data)
+            if data:
+                self.bytes_sent += len(data)
+                yield types.StreamingRecognizeRequest(audio_content=data)
+        if encoder is not None:
+            # The last frames, before the request is half-closed.
+            data = encoder.close()
+            if data:
+                self.bytes_sent += len(data)
+                yield types.StreamingRecognizeRequest(audio_content=data)
+
+    def _audio(self, done):
+        """PCM of one request, until it is done, rolls over or the gate
+        closes."""
+        deadline = time.time() + self.streaming_limit
+        while True:
+            with self._lock:
+                if done.is_set():
+                    return
+                if time.time() > deadline:
+                    self.rollovers += 1
+                    return
+                if self._leftover:
+                    data = self._leftover.popleft()
+                elif self._ended:
+                    return
+                else:
+                    data = self._read(timeout=0.1)
+                    if data is None:
+                        return
+                    if not data:
+                        continue
+                self._unfinalized.append(data)
+            yield data
+
+    def _observe(self, responses):
+        started = time.time()
+        for response in responses:
+            if any(result.is_final for result in response.results):
+                metrics.observe('stt.final', time.time() - started)
+                with self._lock:
+                    self._unfinalized.clear()
+                ended_at = self.pipeline and self.pipeline.speech_ended_at
+                if ended_at:
+                    self.latencies.append(time.time() - ended_at)
+                    metrics.observe('stt.end_of_speech_to_final',
+                            self.latencies[-1])
+                    self.pipeline.speech_ended_at = None
+            elif response.results:
+                metrics.observe('stt.interim', time.time() - started)
+            yield response
+        self._exhausted = True
+
+    def recognize(self, listen_loop):
+        """Runs one streaming request through `listen_loop`."""
+        self._ended = False
+        if self.pipeline is not None and self.pipeline.opens_on_speech:
+            if not self._wait_for_speech():
+                return
+
+        done = threading.Event()
+        self._exhausted = False
+        self.requests += 1
+
+        responses = self.client.streaming_recognize(self.streaming_config,
+                self._requests(done))
+        try:
+            listen_loop(self._observe(responses))
+        except exceptions.OutOfRange:
+            # Hit the duration limit before our own rollover.
+            self._exhausted = True
+        finally:
+            with self._lock:
+                done.set()
+                # When the gate closed the request, the service already saw
+                # all of the utterance it is going to get.
+                if self._exhausted and not self._ended:
+                    self._leftover.extendleft(reversed(self._unfinalized))
+                self._unfinalized.clear()
+
+
 def main():
     # See http://g.co/cloud/speech/docs/languages
     # for a list of supported languages.
@@ -0,0 +1,140 @@
+"""One TTS service shared by live replies, speculation and warm-up.
+
+Requests return futures of cached audio filenames.  Requests for the same
+audio key coalesce into the one in flight, so two callers never
+synthesize or write the same file at once.  A fixed number of workers
+bounds the concurrent API calls, and live requests go ahead of queued
+background ones.  The client is reused and the voice and audio config are
+built once; any object with a `synthesize_speech(input, voice,
+audio_config)` method will do as a client, e.g. replay.FakeTTSClient.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from synthesize_file import synthesize_text_file, synthesize_ssml_file
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+LIVE = 0
+BACKGROUND = 1
+
+
+class TTSService(object):
+    def __init__(self, client, cache, voice, lang, ssml_template='{TXT}',
+            workers=4):
+        self.client = client
+        self.cache = cache
+        self.voice = voice
+        self.lang = lang
+        self.ssml_template = ssml_template
+
+        self.requests = 0
+        self.cached = 0
+        self.coalesced = 0
+        self.synthesized = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        # key -> [future, priority, started, queued at]
+        self._in_flight = {}
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._workers = [threading.Thread(target=self._run,
+                name='tts-{}'.format(i), daemon=True)
+                for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def key(self, txt, ssml=None):
+        if ssml is None:
+            ssml = txt[0] == '<'
+        return self.cache.key(txt, self.voice, self.lang, ssml=ssml)
+
+    def submit(self, txt, ssml=None, priority=LIVE):
+        """Returns a future of the filename of `txt` rendered."""
+        if ssml is None:
+            ssml = txt[0] == '<'
+        key = self.key(txt, ssml)
+        with self._lock:
+            self.requests += 1
+            entry = self._in_flight.get(key)
+            if entry is not None:
+                self.coalesced += 1
+                if priority < entry[1] and not entry[2]:
+                    # Still queued, queue it again ahead of the others.
+                    entry[1] = priority
+                    self._queue.put((priority, next(self._order), key, txt,
+                        ssml))
+                return entry[0]
+
+            future = concurrent.futures.Future()
+            with metrics.span('audio.cache_check'):
+                filename = self.cache.get(key)
+            if filename is not None:
+                self.cached += 1
+                future.set_result(filename)
+                return future
+
+            self._in_flight[key] = [future, priority, False,
+                    time.perf_counter()]
+            self._queue.put((priority, next(self._order), key, txt, ssml))
+        return future
+
+    def synthesize(self, txt, ssml=None, priority=LIVE):
+        return self.submit(txt, ssml, priority).result()
+
+    def _run(self):
+        while True:
+            priority, order, key, txt, ssml = self._queue.get()
+            with self._lock:
+                entry = self._in_flight.get(key)
+                if entry is None or entry[2]:
+                    # Taken by an earlier copy of this request.
+                    continue
+                entry[2] = True
+            future = entry[0]
+            metrics.observe('tts.queue', time.perf_counter() - entry[3])
+
+            try:
+                filename = self._render(key, txt, ssml)
+            except Exception as e:
+                log.warning("TTS of %r failed: %s", txt, e)
+                with self._lock:
+                    self.failed += 1
+                    del self._in_flight[key]
+                future.set_exception(e)
+                continue
+
+            with self._lock:
+                self.synthesized += 1
+                del self._in_flight[key]
+            future.set_result(filename)
+
+    def _render(self, key, txt, ssml):
+        synthesizer = synthesize_text_file
+        if ssml:
+            synthesizer = synthesize_ssml_file
+            txt = self.ssml_template.format(TXT=txt)
+            log.debug("SSML: %s", txt)
+        with self.cache.writer(key, self.voice, self.lang, ssml=ssml) as fh:
+            synthesizer(txt, self.client, fh, lang=self.lang,
+                    voice_name=self.voice)
+        return self.cache.filename(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'cached': self.cached,
+                'coalesced': self.coalesced,
+                'synthesized': self.synthesized,
+                'failed': self.failed,
+                'in_flight': len(self._in_flight),
+            }
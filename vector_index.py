@@ -0,0 +1,152 @@
+"""Dense cosine-similarity index over script phrase vectors.
+
+Example usage:
+    python vector_index.py --entries 50000 --dim 300
+"""
+
+import argparse
+import time
+
+import numpy
+
+
+class VectorIndex(object):
+    """Keeps unit-length vectors in one contiguous float32 matrix.
+
+    Rows ``[0, len(index))`` are live.  ``remove`` moves the last live row
+    into the freed slot, so the live block never has holes and ``search``
+    is a single matrix-vector product.
+    """
+    def __init__(self, dim, capacity=64, dtype=numpy.float32):
+        self.dim = dim
+        self._matrix = numpy.zeros((max(capacity, 1), dim), dtype=dtype)
+        self._keys = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    @property
+    def matrix(self):
+        """View of the live rows, do not keep it across add/remove."""
+        return self._matrix[:len(self._keys)]
+
+    @classmethod
+    def from_matrix(cls, keys, matrix):
+        """Wraps a matrix of unit-length rows, e.g. a mmap, without copying."""
+        index = cls(matrix.shape[1], dtype=matrix.dtype)
+        index._matrix = matrix
+        index._keys = list(keys)
+        index._rows = {k: i for i, k in enumerate(index._keys)}
+        return index
+
+    @staticmethod
+    def normalize(vec):
+        vec = numpy.asarray(vec, dtype=numpy.float32)
+        norm = numpy.sqrt(numpy.dot(vec, vec))
+        if norm > 0:
+            vec = vec / norm
+        return vec
+
+    def _grow(self):
+        matrix = numpy.zeros((max(self._matrix.shape[0] * 2, 1), self.dim),
+                dtype=self._matrix.dtype)
+        matrix[:len(self._keys)] = self.matrix
+        self._matrix = matrix
+
+    def add(self, key, vec):
+        row = self._rows.get(key)
+        if row is None:
+            if len(self._keys) == self._matrix.shape[0]:
+                self._grow()
+            row = len(self._keys)
+            self._rows[key] = row
+            self._keys.append(key)
+        self._matrix[row] = self.normalize(vec)
+
+    def remove(self, key):
+        row = self._rows.pop(key)
+        last = len(self._keys) - 1
+        if row != last:
+            moved = self._keys[last]
+            self._matrix[row] = self._matrix[last]
+            self._keys[row] = moved
+            self._rows[moved] = row
+        self._keys.pop()
+        self._matrix[last] = 0
+
+    def get(self, key):
+        return self._matrix[self._rows[key]]
+
+    def clear(self):
+        self._keys = []
+        self._rows = {}
+        self._matrix[:] = 0
+
+    def search(self, vec, k=1):
+        """Returns up to `k` ``(similarity, key)`` pairs, best first."""
+        n = len(self._keys)
+        if not n:
+            return []
+        scores = self.matrix.dot(self.normalize(vec))
+        if k == 1:
+            best = int(numpy.argmax(scores))
+            return [(float(scores[best]), self._keys[best])]
+        k = min(k, n)
+        if k < n:
+            top = numpy.argpartition(-scores, k - 1)[:k]
+        else:
+            top = numpy.arange(n)
+        top = top[numpy.argsort(-scores[top])]
+        return [(float(scores[i]), self._keys[i]) for i in top]
+
+    def search_batch(self, vecs):
+        """Best ``(similarity, key)`` for every row of `vecs`, or None.
+
+        All rows are scored in one matrix product.
+        """
+        vecs = numpy.asarray(vecs, dtype=numpy.float32)
+        if not len(self._keys):
+            return [None] * len(vecs)
+        norms = numpy.sqrt((vecs * vecs).sum(axis=1, keepdims=True))
+        vecs = vecs / numpy.maximum(norms, 1e-12)
+        scores = self.matrix.dot(vecs.T)
+        best = numpy.argmax(scores, axis=0)
+        return [(float(scores[i, j]), self._keys[i])
+                for j, i in enumerate(best)]
+
+
+def benchmark(entries, dim, queries=200):
+    rng = numpy.random.default_rng(0)
+    index = VectorIndex(dim, capacity=entries)
+    for i, vec in enumerate(rng.standard_normal((entries, dim))):
+        index.add(i, vec)
+    lookups = rng.standard_normal((queries, dim))
+
+    t1 = time.time()
+    for vec in lookups:
+        index.search(vec)
+    elapsed = (time.time() - t1) / queries
+
+    print("{} entries x {} dims: {:.3f} ms per lookup".format(
+        entries, dim, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=300)
+    args = parser.parse_args()
+
+    benchmark(args.entries, args.dim)
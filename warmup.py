@@ -0,0 +1,103 @@
+"""Background pre-synthesis of script replies.
+
+The first time a reply is used on stage the audience would otherwise wait
+for a full TTS round trip.  Warmup renders every reply that is not cached
+yet on a bounded thread pool, with retries and a shared rate limit, and
+reports progress until the show is fully cached.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """Spaces calls at least 1/rate seconds apart across threads."""
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next = 0.
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Warmup(object):
+    def __init__(self, synthesize, is_cached, workers=4, rate=5.,
+            retries=3, backoff=1., on_progress=None):
+        self.synthesize = synthesize
+        self.is_cached = is_cached
+        self.retries = retries
+        self.backoff = backoff
+        self.on_progress = on_progress or self.print_progress
+
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.ready = threading.Event()
+        self.ready.set()
+
+        self._limiter = RateLimiter(rate)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='warmup')
+
+    @staticmethod
+    def print_progress(warmup):
+        log.info("Warm-up: %d of %d replies cached, %d failed%s",
+                warmup.done, warmup.total, warmup.failed,
+                ", show is ready" if warmup.ready.is_set() else "")
+
+    def submit(self, replies):
+        """Queues every reply that is neither cached nor already queued."""
+        queued = []
+        with self._lock:
+            for txt in replies:
+                if not txt or txt in self._pending or self.is_cached(txt):
+                    continue
+                self._pending.add(txt)
+                self.total += 1
+                queued.append(txt)
+            if queued:
+                self.ready.clear()
+
+        for txt in queued:
+            self._executor.submit(self._render, txt)
+
+    def _render(self, txt):
+        ok = False
+        for attempt in range(self.retries):
+            self._limiter.wait()
+            try:
+                self.synthesize(txt)
+                ok = True
+                break
+            except Exception as e:
+                log.warning("Warm-up of %r failed: %s", txt, e)
+                time.sleep(self.backoff * 2 ** attempt)
+
+        with self._lock:
+            self._pending.discard(txt)
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            if not self._pending:
+                self.ready.set()
+        self.on_progress(self)
+
+    def wait(self, timeout=None):
+        """Blocks until nothing is pending, returns False on timeout."""
+        return self.ready.wait(timeout)
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)